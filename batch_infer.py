@@ -0,0 +1,163 @@
+'''
+Headless batch inference of WHENet on images with known head boxes.
+
+The box list uses the demo.py bbox.txt format, extended to several boxes per
+image (comma separated), and an image may also appear on several lines:
+
+    image_name,x_min y_min x_max y_max[,x_min y_min x_max y_max ...]
+
+Images are decoded and cropped on a thread pool while the main thread groups
+the crops of many images into large WHENet batches. Results are streamed to a
+.csv file, or to a .npy file of records whose image_id indexes the lines of
+the accompanying <output>.files.txt.
+'''
+import os
+import argparse
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import cv2
+from whenet import WHENet
+from utils import RoiCropper
+from result_store import NpyAppender
+
+RESULT_DTYPE = np.dtype([('image_id', np.int64), ('box', np.int32, (4,)),
+                         ('yaw', np.float32), ('pitch', np.float32), ('roll', np.float32)])
+
+def parse_bbox_line(line):
+    parts = line.strip().split(',')
+    boxes = [[int(float(v)) for v in p.split()] for p in parts[1:] if p.strip()]
+    if any(len(box) != 4 for box in boxes):
+        raise ValueError('boxes must be x_min y_min x_max y_max')
+    return parts[0], np.array(boxes, dtype=np.int32).reshape(-1, 4)
+
+def read_bbox_file(path):
+    '''Yields (filename, boxes) per line, lines that do not parse are reported and skipped'''
+    with open(path, 'r') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                yield parse_bbox_line(line)
+            except ValueError as e:
+                print('{} line {} skipped: {}'.format(path, line_number, e))
+
+def load_crops(root, filename, boxes):
+    '''(boxes clipped to the image, crops), or None when the image can not be read or cropped,
+    which is reported here'''
+    img = cv2.imread(os.path.join(root, filename))
+    if img is None:
+        print('could not read', filename)
+        return None
+    try:
+        boxes = boxes.copy()
+        boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, img.shape[1])
+        boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, img.shape[0])
+        return boxes, RoiCropper(capacity=len(boxes))(img, boxes)
+    except Exception as e: # one bad line must not end a long run
+        print('{}: {}'.format(filename, e))
+        return None
+
+def prefetch(executor, fn, items, depth):
+    '''Ordered executor.map that keeps at most depth tasks in flight'''
+    pending = collections.deque()
+    for item in items:
+        pending.append((item, executor.submit(fn, *item)))
+        if len(pending) >= depth:
+            item, future = pending.popleft()
+            yield item, future.result()
+    while pending:
+        item, future = pending.popleft()
+        yield item, future.result()
+
+class CsvWriter(object):
+    '''Writes one line per head, only the names of images with heads not yet written are kept'''
+    def __init__(self, path):
+        self.f = open(path, 'w')
+        self.f.write('image,x_min,y_min,x_max,y_max,yaw,pitch,roll\n')
+        self.files = {}
+        self.num_files = 0
+
+    def add_image(self, filename):
+        self.files[self.num_files] = filename
+        self.num_files += 1
+        return self.num_files - 1
+
+    def write(self, records):
+        for r in records:
+            self.f.write('{},{},{},{},{},{:.3f},{:.3f},{:.3f}\n'.format(
+                self.files[r['image_id']], *r['box'], r['yaw'], r['pitch'], r['roll']))
+        # records come in image order, earlier images are complete
+        if len(records):
+            last = int(records['image_id'][-1])
+            for image_id in [i for i in self.files if i < last]:
+                del self.files[image_id]
+
+    def close(self):
+        self.f.close()
+
+class NpyWriter(object):
+    '''Appends RESULT_DTYPE records to a .npy file, the header is patched with the final count on close'''
+    def __init__(self, path):
+        self.records = NpyAppender(path, RESULT_DTYPE)
+        self.files = open(path + '.files.txt', 'w')
+        self.num_files = 0
+
+    def add_image(self, filename):
+        self.files.write(filename + '\n')
+        self.num_files += 1
+        return self.num_files - 1
+
+    def write(self, records):
+        self.records.write(records)
+
+    def close(self):
+        self.records.close()
+        self.files.close()
+
+def run(args):
+    model = WHENet(snapshot=args.snapshot, uint8_input=True)
+    writer = NpyWriter(args.output) if args.output.endswith('.npy') else CsvWriter(args.output)
+    batch = np.zeros((args.batch_size, 224, 224, 3), dtype=np.uint8)
+    records = np.zeros(args.batch_size, dtype=RESULT_DTYPE)
+    filled = 0
+
+    def flush(n):
+        records['yaw'][:n], records['pitch'][:n], records['roll'][:n] = model.get_angles(batch[:n], max_batch=args.batch_size).T
+        writer.write(records[:n])
+
+    num_images = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        for (filename, _), loaded in prefetch(executor, lambda f, b: load_crops(args.root, f, b),
+                                              read_bbox_file(args.bbox_file), depth=4 * args.workers):
+            if loaded is None:
+                continue
+            boxes, crops = loaded
+            image_id = writer.add_image(filename)
+            num_images += 1
+            for box, crop in zip(boxes, crops):
+                batch[filled] = crop
+                records['image_id'][filled] = image_id
+                records['box'][filled] = box
+                filled += 1
+                if filled == args.batch_size:
+                    flush(filled)
+                    filled = 0
+        if filled:
+            flush(filled)
+    writer.close()
+    print('{} images processed'.format(num_images))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='headless whenet batch inference on images with head boxes')
+    parser.add_argument('--bbox_file', type=str, default='Sample/bbox.txt', help='image_name,x_min y_min x_max y_max[,...] per line')
+    parser.add_argument('--root', type=str, default='Sample/', help='directory the image names are relative to')
+    parser.add_argument('--snapshot', type=str, default='WHENet.h5', help='whenet snapshot path')
+    parser.add_argument('--output', type=str, default='poses.csv', help='result file, .csv or .npy')
+    parser.add_argument('--batch_size', type=int, default=64, help='crops per whenet forward pass')
+    parser.add_argument('--workers', type=int, default=8, help='image decoding threads')
+    parser.add_argument('--gpu', type=str, default='0', help='gpu')
+    args = parser.parse_args()
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    run(args)
@@ -0,0 +1,200 @@
+'''
+Per-stage latency benchmark of the detection + head pose pipeline.
+
+WHENet and the YOLO body are built with randomly initialized weights, so no
+downloads are needed, and every stage is timed separately on synthetic frames:
+
+    decode, letterbox, detection, nms, crop, pose, drawing, encode
+
+sweeping frame resolution, YOLO input size, faces per frame and WHENet batch
+size. p50/p95/p99 latency (ms) and throughput (fps) are written as JSON, e.g.
+
+    python benchmark.py --output bench.json --faces 1 4 16 --batch_sizes 1 8 32
+
+With --stages startup, the cold start (imports plus model construction) is
+measured in fresh interpreters instead; the first run fills --cache_dir:
+
+    python benchmark.py --stages startup --snapshot WHENet.h5 --yolo_model yolo_v3/data/head_detect.h5 --cache_dir .model_cache
+'''
+import os
+import sys
+import json
+import argparse
+import subprocess
+from timeit import default_timer as timer
+import numpy as np
+import cv2
+
+def time_fn(fn, iters, warmup):
+    for _ in range(warmup):
+        fn()
+    times = np.zeros(iters)
+    for i in range(iters):
+        tic = timer()
+        fn()
+        times[i] = timer() - tic
+    return times
+
+def summarize(stage, times, **params):
+    p50, p95, p99 = np.percentile(times, [50, 95, 99]) * 1000.
+    result = {'stage': stage, 'p50_ms': p50, 'p95_ms': p95, 'p99_ms': p99,
+              'fps': 1. / np.mean(times), 'iters': len(times)}
+    result.update(params)
+    print('{:>10} {:<45} p50 {:8.2f} ms  p95 {:8.2f} ms  p99 {:8.2f} ms {:9.1f} fps'.format(
+        stage, ' '.join('{}={}'.format(k, v) for k, v in sorted(params.items())), p50, p95, p99, result['fps']))
+    return result
+
+def synthetic_frame(width, height, seed=0):
+    '''Smooth random image, compresses like camera footage rather than like white noise'''
+    rng = np.random.RandomState(seed)
+    small = rng.randint(0, 255, (height // 16 + 1, width // 16 + 1, 3)).astype(np.uint8)
+    return cv2.GaussianBlur(cv2.resize(small, (width, height)), (5, 5), 0)
+
+def synthetic_boxes(num_faces, width, height, seed=0):
+    '''num_faces head boxes (y_min, x_min, y_max, x_max) inside the frame'''
+    rng = np.random.RandomState(seed)
+    size = rng.uniform(0.05, 0.2, num_faces) * min(width, height)
+    y = rng.uniform(0, height - size)
+    x = rng.uniform(0, width - size)
+    return np.stack([y, x, y + size, x + size], axis=1)
+
+def bench_yolo(args, results):
+    from keras import backend as K
+    from keras.layers import Input
+    from yolo_v3.model import yolo_body, tiny_yolo_body, yolo_eval
+    from yolo_v3.utils import FrameLetterbox
+    from yolo_v3.decode import YoloDecoder
+    from yolo_v3.yolo_postprocess import data_file
+
+    if args.tiny:
+        # default tiny YOLOv3 anchors, the repo only ships the anchors of the full model
+        anchors = np.array([10,14, 23,27, 37,58, 81,82, 135,169, 344,319], dtype=np.float64).reshape(-1, 2)
+    else:
+        with open(data_file('yolo_anchors.txt')) as f:
+            anchors = np.array([float(x) for x in f.readline().split(',')]).reshape(-1, 2)
+    num_classes = 1
+    body = tiny_yolo_body if args.tiny else yolo_body
+    model = body(Input(shape=(None, None, 3)), len(anchors) // (2 if args.tiny else 3), num_classes)
+    sess = K.get_session()
+    image_shape = K.placeholder(shape=(2, ))
+    boxes, scores, classes = yolo_eval(model.output, anchors, num_classes, image_shape,
+                                       score_threshold=args.score, iou_threshold=args.iou)
+    decoder = YoloDecoder(anchors, num_classes, score_threshold=args.score, iou_threshold=args.iou)
+
+    for width, height in args.frame_sizes:
+        frame = synthetic_frame(width, height)
+        jpeg = cv2.imencode('.jpg', frame)[1]
+        results.append(summarize('decode', time_fn(lambda: cv2.imdecode(jpeg, cv2.IMREAD_COLOR), args.iters, args.warmup),
+                                 frame_size='{}x{}'.format(width, height)))
+        for yolo_size in args.yolo_sizes:
+            params = dict(frame_size='{}x{}'.format(width, height), yolo_size=yolo_size)
+            letterbox = FrameLetterbox((yolo_size, yolo_size))
+            results.append(summarize('letterbox', time_fn(lambda: letterbox(frame), args.iters, args.warmup), **params))
+            image_data = letterbox(frame)
+            feed = {model.input: image_data, K.learning_phase(): 0}
+            results.append(summarize('detection', time_fn(lambda: sess.run(model.output, feed), args.iters, args.warmup), **params))
+            outputs = sess.run(model.output, feed)
+            # feed the raw outputs back in so only the post-processing subgraph runs
+            nms_feed = dict(zip(model.output, outputs))
+            nms_feed[image_shape] = (height, width)
+            results.append(summarize('nms', time_fn(lambda: sess.run([boxes, scores, classes], nms_feed), args.iters, args.warmup),
+                                     decode='graph', **params))
+            results.append(summarize('nms', time_fn(lambda: decoder(outputs, (height, width)), args.iters, args.warmup),
+                                     decode='numpy', **params))
+
+def bench_pose(args, results):
+    from whenet import WHENet
+    from utils import RoiCropper, expand_bboxes, OverlayRenderer
+
+    whenet = WHENet(uint8_input=True)
+    cropper = RoiCropper()
+    render = OverlayRenderer()
+    for width, height in args.frame_sizes:
+        frame = synthetic_frame(width, height)
+        for faces in args.faces:
+            params = dict(frame_size='{}x{}'.format(width, height), faces=faces)
+            boxes = expand_bboxes(synthetic_boxes(faces, width, height), frame.shape)
+            results.append(summarize('crop', time_fn(lambda: cropper(frame, boxes), args.iters, args.warmup), **params))
+            crops = cropper(frame, boxes).copy()
+            for batch_size in args.batch_sizes:
+                results.append(summarize('pose', time_fn(lambda: whenet.get_angles(crops, max_batch=batch_size), args.iters, args.warmup),
+                                         batch_size=batch_size, **params))
+            angles = whenet.get_angles(crops)
+            canvas = frame.copy()
+            results.append(summarize('drawing', time_fn(lambda: render(canvas, boxes, angles), args.iters, args.warmup), **params))
+        # MJPG output of demo_video.py is one JPEG per frame
+        results.append(summarize('encode', time_fn(lambda: cv2.imencode('.jpg', frame), args.iters, args.warmup),
+                                 frame_size='{}x{}'.format(width, height)))
+
+def startup_child(args):
+    '''Runs in a fresh interpreter, prints the cold start timings as json'''
+    tic = timer()
+    from whenet import WHENet
+    from yolo_v3.yolo_postprocess import YOLO
+    timings = {'import_s': timer() - tic}
+    tic = timer()
+    WHENet(snapshot=args.snapshot, uint8_input=True, cache_dir=args.cache_dir)
+    timings['whenet_s'] = timer() - tic
+    if args.yolo_model:
+        tic = timer()
+        YOLO(model_path=args.yolo_model, cache_dir=args.cache_dir)
+        timings['yolo_s'] = timer() - tic
+    print(json.dumps(timings))
+
+def bench_startup(args, results):
+    cmd = [sys.executable, os.path.abspath(__file__), '--startup_child']
+    for name in ('snapshot', 'yolo_model', 'cache_dir'):
+        if getattr(args, name):
+            cmd += ['--' + name, getattr(args, name)]
+    for run in range(args.startup_runs):
+        tic = timer()
+        output = subprocess.check_output(cmd, cwd=os.path.dirname(os.path.abspath(__file__)))
+        timings = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+        timings.update({'stage': 'startup', 'run': run, 'total_s': timer() - tic})
+        print('   startup run={} '.format(run) + ' '.join('{}={:.2f}'.format(k, v) for k, v in sorted(timings.items())
+                                                        if k.endswith('_s')))
+        results.append(timings)
+
+def main(args):
+    results = []
+    if 'startup' in args.stages:
+        bench_startup(args, results)
+    if 'pose' in args.stages:
+        bench_pose(args, results)
+    if 'yolo' in args.stages:
+        bench_yolo(args, results)
+    report = {'config': {k: v for k, v in vars(args).items() if k != 'output'}, 'results': results}
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to', args.output)
+
+def frame_size(s):
+    width, height = s.lower().split('x')
+    return int(width), int(height)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='per-stage latency benchmark with synthetic weights')
+    parser.add_argument('--output', type=str, default='benchmark.json', help='json report path')
+    parser.add_argument('--stages', type=str, nargs='+', default=['pose', 'yolo'], choices=['pose', 'yolo', 'startup'], help='model groups to benchmark')
+    parser.add_argument('--frame_sizes', type=frame_size, nargs='+', default=[(640, 480), (1280, 720), (1920, 1080)], help='WIDTHxHEIGHT')
+    parser.add_argument('--yolo_sizes', type=int, nargs='+', default=[320, 416, 608], help='yolo input resolutions, multiples of 32')
+    parser.add_argument('--faces', type=int, nargs='+', default=[1, 4, 16], help='faces per frame')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32], help='whenet batch sizes')
+    parser.add_argument('--tiny', action='store_true', help='benchmark tiny_yolo_body instead of yolo_body')
+    parser.add_argument('--score', type=float, default=0.3, help='yolo confidence score threshold')
+    parser.add_argument('--iou', type=float, default=0.3, help='yolo iou threshold')
+    parser.add_argument('--iters', type=int, default=50, help='timed iterations per measurement')
+    parser.add_argument('--warmup', type=int, default=5, help='untimed iterations per measurement')
+    parser.add_argument('--snapshot', type=str, default=None, help='startup: whenet snapshot, random weights if not given')
+    parser.add_argument('--yolo_model', type=str, default=None, help='startup: yolo .h5/.pb to load, skipped if not given')
+    parser.add_argument('--cache_dir', type=str, default=None, help='startup: frozen model cache directory')
+    parser.add_argument('--startup_runs', type=int, default=3, help='startup: number of fresh interpreters to time')
+    parser.add_argument('--startup_child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--gpu', type=str, default='0', help='gpu')
+    args = parser.parse_args()
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    if args.startup_child:
+        startup_child(args)
+    else:
+        main(args)
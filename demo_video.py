@@ -1,70 +1,143 @@
 import numpy as np
 import cv2
 from whenet import WHENet
-from utils import draw_axis
+from utils import expand_bboxes, RoiCropper, OverlayRenderer
 import os
 import argparse
 from yolo_v3.yolo_postprocess import YOLO
-from PIL import Image
+from tracker import TrackingDetector
+from fused import FusedPoseDetector
+from pipeline import VideoPipeline, DROP_POLICIES, print_report
 
 
-def process_detection( model, img, bbox, args ):
+class FrameOutput(object):
+    """Overlay, window and video file of the demo, plus an optional per head csv.
+    With --headless nothing is drawn, shown or encoded and only the csv is written."""
+    def __init__( self, args, frame_shape ):
+        self.render = OverlayRenderer(display=args.display, enabled=not args.headless)
+        self.show = not args.headless
+        self.out = None
+        if not args.headless:
+            fourcc = cv2.VideoWriter_fourcc(*'MJPG')
+            self.out = cv2.VideoWriter(args.output, fourcc, 30, (frame_shape[1], frame_shape[0]))  # write the result to a video
+        self.csv = None
+        if args.csv:
+            self.csv = open(args.csv, 'w')
+            self.csv.write('frame,track_id,x_min,y_min,x_max,y_max,yaw,pitch,roll\n')
 
-    y_min, x_min, y_max, x_max = bbox
-    # enlarge the bbox to include more background margin
-    y_min = max(0, y_min - abs(y_min - y_max) / 10)
-    y_max = min(img.shape[0], y_max + abs(y_min - y_max) / 10)
-    x_min = max(0, x_min - abs(x_min - x_max) / 5)
-    x_max = min(img.shape[1], x_max + abs(x_min - x_max) / 5)
-    x_max = min(x_max, img.shape[1])
+    def __call__( self, index, frame, boxes, angles, track_ids=None ):
+        """Returns False when the user quit"""
+        if self.csv is not None:
+            ids = track_ids if track_ids is not None else [''] * len(boxes)
+            for track_id, box, angle in zip(ids, boxes, angles):
+                self.csv.write('{},{},{:.1f},{:.1f},{:.1f},{:.1f},{:.3f},{:.3f},{:.3f}\n'.format(index, track_id, *box, *angle))
+        self.render(frame, boxes, angles, track_ids)
+        if self.out is not None:
+            self.out.write(frame)
+        if self.show:
+            cv2.imshow('output', frame)
+            return cv2.waitKey(1) & 0xFF != ord("q")
+        return True
 
-    img_rgb = img[int(y_min):int(y_max), int(x_min):int(x_max)]
-    img_rgb = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2RGB)
-    img_rgb = cv2.resize(img_rgb, (224, 224))
-    img_rgb = np.expand_dims(img_rgb, axis=0)
+    def close( self ):
+        if self.out is not None:
+            self.out.release()
+        if self.csv is not None:
+            self.csv.close()
+        if self.show:
+            cv2.destroyAllWindows()
 
-    cv2.rectangle(img, (int(x_min), int(y_min)), (int(x_max), int(y_max)), (0,0,0), 2)
-    yaw, pitch, roll = model.get_angle(img_rgb)
-    yaw, pitch, roll = np.squeeze([yaw, pitch, roll])
-    draw_axis(img, yaw, pitch, roll, tdx=(x_min+x_max)/2, tdy=(y_min+y_max)/2, size = abs(x_max-x_min)//2 )
+def process_detections( model, cropper, img, bboxes ):
+    # gather every head in the frame so WHENet runs a single batched forward pass
+    boxes = expand_bboxes(bboxes, img.shape)
+    crops = cropper(img, boxes)
+    return boxes, model.get_angles(crops)
 
-    if args.display == 'full':
-        cv2.putText(img, "yaw: {}".format(np.round(yaw)), (int(x_min), int(y_min)), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (100, 255, 0), 1)
-        cv2.putText(img, "pitch: {}".format(np.round(pitch)), (int(x_min), int(y_min) - 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (100, 255, 0), 1)
-        cv2.putText(img, "roll: {}".format(np.round(roll)), (int(x_min), int(y_min)-30), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (100, 255, 0), 1)
-    return img
+def make_detector( yolo, args ):
+    """fn(frame) -> (track ids or None, bboxes). With --detect_every > 1 YOLO only runs
+    every k frames and a tracker propagates the boxes in between."""
+    if args.detect_every <= 1:
+        return lambda frame: (None, yolo.detect_frame(frame)[0])
+    tracking = TrackingDetector(yolo.detect_frame, detect_every=args.detect_every)
+    def detect(frame):
+        track_ids, bboxes, _ = tracking(frame)
+        return track_ids, bboxes
+    return detect
 
 
 
 def main(args):
-    whenet = WHENet(snapshot=args.snapshot)
+    whenet = WHENet(snapshot=args.snapshot, uint8_input=True, cache_dir=args.cache_dir)
     yolo = YOLO(**vars(args))
+    cropper = RoiCropper()
+    detect = make_detector(yolo, args)
+    fused = FusedPoseDetector(yolo, whenet) if args.fused else None
     VIDEO_SRC = 0 if args.video == '' else args.video # if video clip is passed, use web cam
     cap = cv2.VideoCapture(VIDEO_SRC)
     print('cap info',VIDEO_SRC)
     ret, frame = cap.read()
-    fourcc = cv2.VideoWriter_fourcc(*'MJPG')
-    out = cv2.VideoWriter(args.output, fourcc, 30, (frame.shape[1], frame.shape[0]))  # write the result to a video
+    output = FrameOutput(args, frame.shape)
 
+    index = 0
     while True:
         try:
             ret, frame = cap.read()
         except:
             break
-        frame_rgb = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-        img_pil = Image.fromarray(frame_rgb)
-        bboxes, scores, classes = yolo.detect(img_pil)
-        for bbox in bboxes:
-            frame = process_detection(whenet, frame, bbox, args)
-        cv2.imshow('output',frame)
-        out.write(frame)
-        key = cv2.waitKey(1) & 0xFF
-        if key == ord("q"):
+        if not ret:
             break
+        track_ids = None
+        if fused is not None:
+            boxes, _, angles = fused(frame)
+        else:
+            track_ids, bboxes = detect(frame)
+            boxes, angles = process_detections(whenet, cropper, frame, bboxes)
+        if not output(index, frame, boxes, angles, track_ids):
+            break
+        index += 1
+
+    # cleanup
+    cap.release()
+    output.close()
+
+def read_frames(cap):
+    index = 0
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield {'index': index, 'frame': frame}
+        index += 1
+
+def main_pipelined(args):
+    whenet = WHENet(snapshot=args.snapshot, uint8_input=True, cache_dir=args.cache_dir)
+    yolo = YOLO(**vars(args))
+    cropper = RoiCropper()
+    detect_heads = make_detector(yolo, args)
+    VIDEO_SRC = 0 if args.video == '' else args.video # if video clip is passed, use web cam
+    cap = cv2.VideoCapture(VIDEO_SRC)
+    print('cap info',VIDEO_SRC)
+    ret, frame = cap.read()
+    frame_output = FrameOutput(args, frame.shape)
+
+    def detect(item):
+        item['track_ids'], item['bboxes'] = detect_heads(item['frame'])
+        return item
+
+    def estimate_pose(item):
+        item['boxes'], item['angles'] = process_detections(whenet, cropper, item['frame'], item['bboxes'])
+        return item
+
+    def output(item):
+        return frame_output(item['index'], item['frame'], item['boxes'], item['angles'], item['track_ids'])
+
+    engine = VideoPipeline(read_frames(cap), [('detect', detect), ('pose', estimate_pose)], output,
+                           queue_size=args.queue_size, policy=args.drop_policy, graph=yolo.sess.graph)
+    print_report(engine.run())
 
     # cleanup
     cap.release()
-    cv2.destroyAllWindows()
+    frame_output.close()
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='whenet demo with yolo')
@@ -73,9 +146,23 @@ if __name__ == "__main__":
     parser.add_argument('--display', type=str, default='simple', help='display all euler angle (simple, full)')
     parser.add_argument('--score', type=float, default=0.3, help='yolo confidence score threshold')
     parser.add_argument('--iou', type=float, default=0.3, help='yolo iou threshold')
+    parser.add_argument('--decode', type=str, default='graph', choices=('graph', 'numpy'), help='decode yolo outputs in the TF graph or with numpy')
     parser.add_argument('--gpu', type=str, default='0', help='gpu')
+    parser.add_argument('--cache_dir', type=str, default=None, help='cache frozen models here for a faster start on the next run')
     parser.add_argument('--output', type=str, default='test.avi', help='output video name')
+    parser.add_argument('--headless', action='store_true', help='no overlay, window or output video, only numbers (see --csv)')
+    parser.add_argument('--csv', type=str, default=None, help='write frame, track id, box and angles of every head to this csv')
+    parser.add_argument('--detect_every', type=int, default=1, help='run yolo every k frames and track heads in between')
+    parser.add_argument('--fused', action='store_true', help='run detection, cropping and pose in one graph, one sess.run per frame')
+    parser.add_argument('--pipelined', action='store_true', help='run decode, detection, pose and output on separate threads')
+    parser.add_argument('--queue_size', type=int, default=4, help='max frames buffered between pipeline stages')
+    parser.add_argument('--drop_policy', type=str, default='block', choices=DROP_POLICIES,
+                        help='what to do when detection falls behind capture (block, drop_oldest, latest)')
     args = parser.parse_args()
     os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
     os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
-    main(args)
\ No newline at end of file
+    assert not (args.fused and (args.pipelined or args.detect_every > 1)), '--fused runs the serial loop without tracking'
+    if args.pipelined:
+        main_pipelined(args)
+    else:
+        main(args)
\ No newline at end of file
@@ -0,0 +1,74 @@
+'''
+Head detection, cropping and pose estimation in a single TensorFlow graph.
+
+The yolo_eval boxes are expanded by the demo margin, cropped and resized to
+224x224 with tf.image.crop_and_resize straight from the uint8 frame and fed
+through the WHENet layers, so one sess.run per frame returns boxes, scores and
+angles, and neither boxes nor crops make a round trip through Python:
+
+    fused = FusedPoseDetector(YOLO(), WHENet('WHENet.h5'))
+    boxes, scores, angles = fused(frame)
+'''
+import tensorflow as tf
+from keras import backend as K
+from whenet import IMAGENET_MEAN, IMAGENET_STD, decode_angles
+from yolo_v3.utils import FrameLetterbox
+
+def expand_boxes(boxes, image_shape):
+    '''utils.expand_bboxes in the graph, (N,4) y_min, x_min, y_max, x_max -> x_min, y_min, x_max, y_max'''
+    height, width = image_shape[0], image_shape[1]
+    y_min, x_min, y_max, x_max = tf.unstack(boxes, axis=1)
+    y_min = tf.maximum(0., y_min - tf.abs(y_min - y_max) / 10)
+    y_max = tf.minimum(height, y_max + tf.abs(y_min - y_max) / 10)
+    x_min = tf.maximum(0., x_min - tf.abs(x_min - x_max) / 5)
+    x_max = tf.minimum(width, x_max + tf.abs(x_min - x_max) / 5)
+    return tf.stack([x_min, y_min, x_max, y_max], axis=1)
+
+def crop_boxes(boxes, image_shape, size):
+    '''Normalized crop_and_resize boxes sampling the same pixel centers as RoiCropper,
+    i.e. cv2.resize of img[y_min:y_max, x_min:x_max] with the box truncated to integers'''
+    x_min, y_min, x_max, y_max = tf.unstack(tf.floor(boxes), axis=1)
+    height, width = image_shape[0] - 1., image_shape[1] - 1.
+    step_y = (y_max - y_min) / size
+    step_x = (x_max - x_min) / size
+    y1 = (y_min + step_y / 2 - .5) / height
+    x1 = (x_min + step_x / 2 - .5) / width
+    y2 = (y_max - step_y / 2 - .5) / height
+    x2 = (x_max - step_x / 2 - .5) / width
+    # the first / last sample of a box on the image border lies up to half a pixel outside it when
+    # upscaling. cv2 replicates the border there, crop_and_resize would sample zeros, so the end points
+    # are clipped instead, which spreads the samples of such a box slightly differently from cv2
+    return tf.clip_by_value(tf.stack([y1, x1, y2, x2], axis=1), 0., 1.)
+
+class FusedPoseDetector(object):
+    '''YOLO and WHENet joined into one graph on the YOLO session'''
+    def __init__(self, yolo, whenet, size=224):
+        assert yolo.boxes is not None, 'the fused graph needs YOLO(decode="graph")'
+        assert hasattr(whenet, 'base_model'), 'the fused graph needs the keras WHENet, not a .tflite or cached graph'
+        assert yolo.model_image_size != (None, None), 'the fused graph needs a fixed model_image_size'
+        self.yolo = yolo
+        self.letterbox = FrameLetterbox(tuple(reversed(yolo.model_image_size)))
+        self.frame = tf.placeholder(tf.uint8, shape=(None, None, 3), name='fused_frame')
+        image_shape = tf.cast(tf.shape(self.frame)[:2], tf.float32)
+        self.boxes = expand_boxes(yolo.boxes, image_shape)
+        self.scores = yolo.scores
+
+        num_boxes = tf.shape(self.boxes)[0]
+        # frames without heads crop a dummy box, so WHENet never runs on an empty batch
+        boxes = tf.cond(num_boxes > 0, lambda: crop_boxes(self.boxes, image_shape, size),
+                        lambda: tf.constant([[0., 0., 1., 1.]]))
+        crops = tf.image.crop_and_resize(tf.expand_dims(self.frame, 0), boxes,
+                                         tf.zeros(tf.shape(boxes)[:1], dtype=tf.int32), (size, size))
+        crops = tf.reverse(crops, axis=[-1]) # BGR -> RGB
+        crops = (crops / 255. - IMAGENET_MEAN) / IMAGENET_STD
+        self.angles = decode_angles(whenet.base_model(crops))[:num_boxes]
+
+    def __call__(self, frame):
+        '''BGR frame -> boxes (N,4 x_min, y_min, x_max, y_max with margin), scores (N,),
+        angles (N,3 yaw, pitch, roll)'''
+        return self.yolo.sess.run([self.boxes, self.scores, self.angles], feed_dict={
+            self.yolo.yolo_model.input: self.letterbox(frame),
+            self.yolo.input_image_shape: frame.shape[:2],
+            self.frame: frame,
+            K.learning_phase(): 0
+        })
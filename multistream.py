@@ -0,0 +1,210 @@
+'''
+Many cameras (or video files standing in for them) served by one YOLO and one
+WHENet instance.
+
+Every stream is decoded on its own thread into a small bounded queue. The
+scheduler takes at most one frame per stream per round, starting each round at
+the next stream, so a fast or busy stream can not starve the others. The frames
+of a round go through one YOLO detect_batch call and all of their heads through
+one WHENet forward pass. Results come out per stream:
+
+    for stream, result in run_streams(['cam0.mp4', 'cam1.mp4', 0], whenet, yolo):
+        print(stream, result.index, result.angles)
+
+    python multistream.py --videos cam0.mp4 cam1.mp4 --output_dir results/
+'''
+import os
+import argparse
+import threading
+from queue import Empty
+from timeit import default_timer as timer
+import numpy as np
+import cv2
+from whenet import WHENet
+from utils import expand_bboxes, RoiCropper
+from pipeline import FrameQueue, DROP_POLICIES
+from pose_stream import FrameResult, read_frames
+
+_END = object()
+
+class Stream(object):
+    '''One source decoded on its own thread into a bounded FrameQueue, ready is set on every put'''
+    def __init__(self, stream_id, source, ready, queue_size=2, policy=None, frame_step=1, stop_event=None):
+        self.stream_id = stream_id
+        self.source = source
+        live = isinstance(source, int)
+        # files must not lose frames, cameras should not build up latency
+        self.queue = FrameQueue(queue_size, policy or ('latest' if live else 'block'))
+        self.cap = cv2.VideoCapture(source)
+        if not self.cap.isOpened():
+            self.cap.release()
+            raise IOError("Couldn't open webcam or video {}".format(source))
+        self.frames = read_frames(self.cap, frame_step, live=live)
+        self.ready = ready
+        self.stop_event = stop_event
+        self.finished = False
+        self.decoded = 0
+        self.processed = 0
+        self.thread = threading.Thread(target=self._decode, name='decode_{}'.format(stream_id))
+        self.thread.daemon = True
+
+    def _decode(self):
+        for item in self.frames:
+            if self.stop_event is not None and self.stop_event.is_set():
+                break
+            self.decoded += 1
+            self.queue.put(item, self.stop_event)
+            self.ready.set()
+        self.queue.put(_END, self.stop_event)
+        self.ready.set()
+        self.cap.release()
+
+    def report(self):
+        return {'stream': self.stream_id, 'source': str(self.source), 'decoded': self.decoded,
+                'processed': self.processed, 'dropped': self.queue.dropped}
+
+class MultiStreamScheduler(object):
+    '''Round robin scheduling of N streams onto shared models, see the module docstring'''
+    def __init__(self, sources, whenet, yolo, max_batch=16, queue_size=2, policy=None, frame_step=1):
+        self.whenet = whenet
+        self.yolo = yolo
+        self.max_batch = max_batch
+        self.ready = threading.Event()
+        self.stop_event = threading.Event()
+        self.streams = []
+        try:
+            for i, source in enumerate(sources):
+                self.streams.append(Stream(i, source, self.ready, queue_size, policy, frame_step, self.stop_event))
+        except Exception:
+            # the threads are not started yet, the captures opened so far are ours to release
+            for stream in self.streams:
+                stream.cap.release()
+            raise
+        self.cropper = RoiCropper()
+        self.next_stream = 0
+        self.batches = 0
+        self.start = None
+
+    def _next_round(self):
+        '''Up to max_batch (stream, item) pairs, at most one per stream'''
+        while True:
+            active = [s for s in self.streams if not s.finished]
+            if not active:
+                return []
+            self.ready.clear()
+            batch = []
+            n = len(self.streams)
+            for k in range(n):
+                stream = self.streams[(self.next_stream + k) % n]
+                if stream.finished:
+                    continue
+                try:
+                    item = stream.queue.get(timeout=0)
+                except Empty:
+                    continue
+                if item is _END:
+                    stream.finished = True
+                    continue
+                batch.append((stream, item))
+                if len(batch) == self.max_batch:
+                    # the next round starts after the last stream served
+                    self.next_stream = (self.next_stream + k + 1) % n
+                    return batch
+            if batch:
+                self.next_stream = (self.next_stream + 1) % n
+                return batch
+            self.ready.wait(0.05)
+
+    def _process(self, batch):
+        frames = [item[2] for _, item in batch]
+        detections = self.yolo.detect_batch(frames, batch_size=len(frames))
+        # heads of every stream in the round go through WHENet together
+        boxes = [expand_bboxes(bboxes, frame.shape) for frame, (bboxes, _, _) in zip(frames, detections)]
+        counts = [len(b) for b in boxes]
+        crops = np.zeros((sum(counts), self.cropper.size, self.cropper.size, 3), dtype=np.uint8)
+        offsets = np.cumsum([0] + counts)
+        for frame, b, begin, end in zip(frames, boxes, offsets[:-1], offsets[1:]):
+            crops[begin:end] = self.cropper(frame, b)
+        angles = self.whenet.get_angles(crops)
+        angles, entropy = angles if self.whenet.uncertainty else (angles, None)
+        for (stream, (index, timestamp, _)), b, (_, scores, _), begin, end in zip(
+                batch, boxes, detections, offsets[:-1], offsets[1:]):
+            stream.processed += 1
+            yield stream.stream_id, FrameResult(index, timestamp, b, np.asarray(scores, dtype=np.float32),
+                                                angles[begin:end], None,
+                                                entropy[begin:end] if entropy is not None else None)
+
+    def __iter__(self):
+        '''Yields (stream id, FrameResult) until every stream has ended'''
+        self.start = timer()
+        for stream in self.streams:
+            stream.thread.start()
+        try:
+            while True:
+                batch = self._next_round()
+                if not batch:
+                    break
+                self.batches += 1
+                for result in self._process(batch):
+                    yield result
+        finally:
+            self.stop_event.set()
+            for stream in self.streams:
+                stream.thread.join(timeout=1.)
+
+    def report(self):
+        wall = timer() - self.start if self.start else 0.
+        streams = [s.report() for s in self.streams]
+        for s in streams:
+            s['fps'] = s['processed'] / wall if wall > 0 else 0.
+        processed = sum(s['processed'] for s in streams)
+        return {'streams': streams, 'batches': self.batches,
+                'mean_batch_size': processed / float(self.batches) if self.batches else 0.,
+                'total_fps': processed / wall if wall > 0 else 0.}
+
+def run_streams(sources, whenet, yolo, **kwargs):
+    '''Generator of (stream id, FrameResult) over all sources, see MultiStreamScheduler'''
+    return iter(MultiStreamScheduler(sources, whenet, yolo, **kwargs))
+
+def print_report(report):
+    for s in report['streams']:
+        print('stream {stream:>2}: {processed:6d} frames {fps:7.2f} fps {dropped:5d} dropped  {source}'.format(**s))
+    print('{} batches, {:.1f} frames per batch, {:.2f} fps in total'.format(
+        report['batches'], report['mean_batch_size'], report['total_fps']))
+
+def main(args):
+    from yolo_v3.yolo_postprocess import YOLO
+    from result_store import ResultWriter
+    whenet = WHENet(snapshot=args.snapshot, uint8_input=True, cache_dir=args.cache_dir)
+    yolo = YOLO(score=args.score, iou=args.iou, cache_dir=args.cache_dir)
+    sources = [int(v) if v.isdigit() else v for v in args.videos]
+    scheduler = MultiStreamScheduler(sources, whenet, yolo, max_batch=args.max_batch, queue_size=args.queue_size,
+                                     policy=args.drop_policy, frame_step=args.frame_step)
+    writers = [ResultWriter(os.path.join(args.output_dir, 'stream_{}'.format(i)), meta={'source': str(source)})
+               for i, source in enumerate(sources)] if args.output_dir else None
+    for stream, result in scheduler:
+        if writers is not None:
+            writers[stream].append(result.index, result.timestamp, result.boxes, result.scores, result.angles)
+    if writers is not None:
+        for writer in writers:
+            writer.close()
+    print_report(scheduler.report())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='head pose on many streams with one shared yolo and whenet')
+    parser.add_argument('--videos', type=str, nargs='+', required=True, help='video files or camera indices')
+    parser.add_argument('--snapshot', type=str, default='WHENet.h5', help='whenet snapshot path')
+    parser.add_argument('--score', type=float, default=0.3, help='yolo confidence score threshold')
+    parser.add_argument('--iou', type=float, default=0.3, help='yolo iou threshold')
+    parser.add_argument('--max_batch', type=int, default=16, help='max frames (one per stream) per detection batch')
+    parser.add_argument('--queue_size', type=int, default=2, help='decoded frames buffered per stream')
+    parser.add_argument('--drop_policy', type=str, default=None, choices=DROP_POLICIES,
+                        help='default: block for files, latest for cameras')
+    parser.add_argument('--frame_step', type=int, default=1, help='only estimate every k-th frame of each stream')
+    parser.add_argument('--output_dir', type=str, default=None, help='write a result store per stream here')
+    parser.add_argument('--cache_dir', type=str, default=None, help='frozen model cache directory')
+    parser.add_argument('--gpu', type=str, default='0', help='gpu')
+    args = parser.parse_args()
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    main(args)
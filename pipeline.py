@@ -0,0 +1,185 @@
+'''
+Pipelined video engine: decode, detection, pose estimation and output run as
+separate stages connected by bounded queues so that capture and encode time
+overlap with inference instead of adding onto it.
+'''
+import threading
+from queue import Queue, Empty, Full
+from timeit import default_timer as timer
+
+DROP_POLICIES = ('block', 'drop_oldest', 'latest')
+_END = object()
+
+class FrameQueue(object):
+    '''Bounded queue between two stages.
+
+    block       -- producer waits for space, no frame is ever lost (video files)
+    drop_oldest -- when full the oldest queued frame is discarded
+    latest      -- only the most recent frame is kept, consumers always see the newest one
+    '''
+    def __init__(self, maxsize=4, policy='block'):
+        assert policy in DROP_POLICIES, 'policy must be one of {}'.format(DROP_POLICIES)
+        self.policy = policy
+        self.queue = Queue(maxsize=1 if policy == 'latest' else maxsize)
+        self.dropped = 0
+
+    def put(self, item, stop_event=None):
+        if item is _END or self.policy == 'block':
+            while True:
+                try:
+                    self.queue.put(item, timeout=0.1)
+                    return
+                except Full:
+                    if stop_event is not None and stop_event.is_set():
+                        return
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except Empty:
+                    pass
+
+    def get(self, timeout=0.1):
+        return self.queue.get(timeout=timeout)
+
+class StageStats(object):
+    '''Frame count and busy time of one stage'''
+    def __init__(self, name):
+        self.name = name
+        self.frames = 0
+        self.busy = 0.
+        self.start = None
+        self.end = None
+
+    def add(self, seconds):
+        self.frames += 1
+        self.busy += seconds
+
+    def report(self):
+        wall = (self.end or timer()) - (self.start or timer())
+        return {
+            'stage': self.name,
+            'frames': self.frames,
+            'fps': self.frames / wall if wall > 0 else 0.,
+            'busy_ms': 1000. * self.busy / self.frames if self.frames else 0.,
+            'utilization': self.busy / wall if wall > 0 else 0.,
+        }
+
+class VideoPipeline(object):
+    '''Runs source -> stages... -> sink with each stage on its own thread.
+
+    source -- iterable of items, consumed on a decode thread
+    stages -- list of (name, fn), fn maps an item to an item and runs on its own thread
+    sink   -- fn(item) called on the calling thread (so cv2.imshow stays on the main
+              thread), returning False stops the pipeline
+    graph  -- tf.Graph made default on worker threads, needed by keras models
+
+    An exception in the source or a stage stops the whole pipeline and is raised again by run().
+    '''
+    def __init__(self, source, stages, sink, queue_size=4, policy='block', graph=None):
+        self.source = source
+        self.stages = stages
+        self.sink = sink
+        self.graph = graph
+        self.stop_event = threading.Event()
+        self.error = None
+        # only the decode -> first stage queue may drop frames, later stages apply back pressure
+        self.queues = [FrameQueue(queue_size, policy)] + [FrameQueue(queue_size) for _ in stages]
+        self.stats = [StageStats('decode')] + [StageStats(name) for name, _ in stages] + [StageStats('output')]
+
+    def _fail(self, error):
+        # the first error wins, every thread stops at its next stop_event check
+        if self.error is None:
+            self.error = error
+        self.stop_event.set()
+
+    def _run_source(self):
+        stats, out_q = self.stats[0], self.queues[0]
+        stats.start = timer()
+        try:
+            it = iter(self.source)
+            while not self.stop_event.is_set():
+                tic = timer()
+                try:
+                    item = next(it)
+                except StopIteration:
+                    break
+                stats.add(timer() - tic)
+                out_q.put(item, self.stop_event)
+        except Exception as e:
+            self._fail(e)
+        stats.end = timer()
+        out_q.put(_END, self.stop_event)
+
+    def _run_stage(self, idx):
+        name, fn = self.stages[idx]
+        stats, in_q, out_q = self.stats[idx + 1], self.queues[idx], self.queues[idx + 1]
+        stats.start = timer()
+        try:
+            while not self.stop_event.is_set():
+                try:
+                    item = in_q.get()
+                except Empty:
+                    continue
+                if item is _END:
+                    break
+                tic = timer()
+                if self.graph is not None:
+                    with self.graph.as_default():
+                        item = fn(item)
+                else:
+                    item = fn(item)
+                stats.add(timer() - tic)
+                out_q.put(item, self.stop_event)
+        except Exception as e:
+            self._fail(e)
+        stats.end = timer()
+        out_q.put(_END, self.stop_event)
+
+    def run(self):
+        threads = [threading.Thread(target=self._run_source, name='decode')]
+        threads += [threading.Thread(target=self._run_stage, args=(i,), name=name)
+                    for i, (name, _) in enumerate(self.stages)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        stats, in_q = self.stats[-1], self.queues[-1]
+        stats.start = timer()
+        while self.error is None:
+            try:
+                item = in_q.get()
+            except Empty:
+                if not any(t.is_alive() for t in threads):
+                    break
+                continue
+            if item is _END:
+                break
+            tic = timer()
+            keep_going = self.sink(item)
+            stats.add(timer() - tic)
+            if keep_going is False:
+                break
+        stats.end = timer()
+        self.stop_event.set()
+        for t in threads:
+            t.join(timeout=1.)
+        if self.error is not None:
+            raise self.error
+        return self.report()
+
+    def report(self):
+        stats = [s.report() for s in self.stats]
+        stats[0]['dropped'] = self.queues[0].dropped
+        return stats
+
+def print_report(report):
+    for s in report:
+        line = '{stage:>8}: {frames:6d} frames {fps:7.2f} fps {busy_ms:8.2f} ms/frame {utilization:5.0%} busy'.format(**s)
+        if 'dropped' in s:
+            line += ' {} dropped'.format(s['dropped'])
+        print(line)
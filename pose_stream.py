@@ -0,0 +1,105 @@
+'''
+Streaming head pose API for videos and cameras.
+
+estimate_video is a generator: frames are decoded, detected and estimated only
+as results are consumed, at most batch_size frames are held in memory, and
+breaking out of the loop (or closing the generator) releases the capture:
+
+    from pose_stream import estimate_video
+    for result in estimate_video('IMG_0176.mp4', frame_step=5):
+        print(result.index, result.timestamp, result.angles)   # (N,3) yaw, pitch, roll
+        if result.index > 1000:
+            break
+'''
+import collections
+from timeit import default_timer as timer
+import numpy as np
+import cv2
+from whenet import WHENet
+from utils import expand_bboxes, RoiCropper
+from tracker import TrackingDetector
+
+FrameResult = collections.namedtuple('FrameResult', [
+    'index',      # frame number in the video
+    'timestamp',  # seconds, from the frame rate for files and the wall clock for cameras
+    'boxes',      # (N,4) x_min, y_min, x_max, y_max of the head crops (detections plus margin)
+    'scores',     # (N,) detection (or tracking) confidence
+    'angles',     # (N,3) yaw, pitch, roll in degrees
+    'track_ids',  # (N,) ids with detect_every > 1, else None
+    'entropy',    # (N,3) normalized angle entropy with WHENet(uncertainty=True), else None
+])
+
+def read_frames(cap, frame_step=1, max_frames=None, live=False):
+    '''Yields (index, timestamp, frame) of every frame_step-th frame, skipped frames are grabbed but not decoded'''
+    fps = cap.get(cv2.CAP_PROP_FPS) or 30.
+    start = timer()
+    index = 0
+    count = 0
+    while max_frames is None or count < max_frames:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield index, (timer() - start) if live else index / fps, frame
+        count += 1
+        for _ in range(frame_step - 1):
+            if not cap.grab():
+                return
+        index += frame_step
+
+def _chunks(items, size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def estimate_video(source, whenet=None, yolo=None, snapshot='WHENet.h5', score=0.3, iou=0.3,
+                   detect_every=1, batch_size=1, frame_step=1, max_frames=None):
+    '''Generator of FrameResult for a video file, or a camera when source is an int.
+
+    whenet, yolo -- models to use, built from snapshot / score / iou when not given
+    detect_every -- run YOLO every k frames and track heads in between (see tracker.py)
+    batch_size   -- frames per YOLO / WHENet forward pass, when detect_every is 1
+    frame_step   -- only estimate every frame_step-th frame
+    max_frames   -- stop after this many results
+    '''
+    if whenet is None:
+        whenet = WHENet(snapshot=snapshot, uint8_input=True)
+    if yolo is None:
+        from yolo_v3.yolo_postprocess import YOLO
+        yolo = YOLO(score=score, iou=iou)
+    cap = cv2.VideoCapture(source)
+    if not cap.isOpened():
+        raise IOError("Couldn't open webcam or video")
+    tracking = TrackingDetector(yolo.detect_frame, detect_every=detect_every) if detect_every > 1 else None
+    cropper = RoiCropper()
+    frames = read_frames(cap, frame_step, max_frames, live=isinstance(source, int))
+    try:
+        for chunk in _chunks(frames, 1 if tracking is not None else batch_size):
+            if tracking is not None:
+                track_ids, bboxes, scores = tracking(chunk[0][2])
+                detections = [(bboxes, scores, np.asarray(track_ids))]
+            elif len(chunk) > 1:
+                detections = [(b, s, None) for b, s, _ in yolo.detect_batch([frame for _, _, frame in chunk], batch_size)]
+            else:
+                bboxes, scores, _ = yolo.detect_frame(chunk[0][2])
+                detections = [(bboxes, scores, None)]
+
+            # the heads of every frame in the chunk go through WHENet together
+            boxes = [expand_bboxes(b, frame.shape) for (_, _, frame), (b, _, _) in zip(chunk, detections)]
+            counts = [len(b) for b in boxes]
+            crops = np.zeros((sum(counts), cropper.size, cropper.size, 3), dtype=np.uint8)
+            offsets = np.cumsum([0] + counts)
+            for (_, _, frame), b, begin, end in zip(chunk, boxes, offsets[:-1], offsets[1:]):
+                crops[begin:end] = cropper(frame, b)
+            angles = whenet.get_angles(crops)
+            angles, entropy = angles if whenet.uncertainty else (angles, None)
+
+            for (index, timestamp, _), b, (_, s, ids), begin, end in zip(chunk, boxes, detections, offsets[:-1], offsets[1:]):
+                yield FrameResult(index, timestamp, b, np.asarray(s, dtype=np.float32), angles[begin:end], ids,
+                                  entropy[begin:end] if entropy is not None else None)
+    finally:
+        cap.release()
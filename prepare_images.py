@@ -28,13 +28,37 @@ named according to the sequence name.
 For each sequence, extract the hdFace3d.tar files in place which 
 will create a hdFace3d directory.
 
-In the entry point at the bottom of the file, set the root directory
-for the panoptic data, either mtc or haggling, containing the
-sequences.  Set the output path and, if you are regenerating data,
-remove the annotation.txt file (otherwise it will be appended to.)
+Run the script with --root set to the directory of the panoptic data,
+either mtc or haggling, containing the sequences. Set the output path
+with --output and, if you are regenerating mtc data, remove the
+annotation.txt file (otherwise it will be appended to.)
 
 Choose whether you want to process mtc data or haggling data with 
-the 'do_mtc' flag, setting it to True for mtc and false for haggling.
+the --mtc flag.
+
+Haggling data is split into (sequence, camera) units which are run on
+a pool of --workers processes. Every unit writes its annotation lines to
+its own shard file, and the shards are appended to annotation.txt in
+sequence and camera order once all units are done:
+
+````
+python prepare_images.py --root /home/tmp/panoptic-toolbox --workers 16
+````
+
+With --frame_major every sequence is read with all of its cameras in
+lockstep, so each hdFace3d file is parsed and its faces aligned to the
+reference head once per frame instead of once per camera. A unit is then a
+whole sequence. The annotation lines still go to per camera shards, so
+annotation.txt comes out the same as without the flag.
+
+Annotation lines are buffered and written to the shards in bulk. Next to
+each shard a manifest records the last finished frame of the camera, so
+a run that was interrupted picks up where it stopped when started again
+with the same arguments. A camera that fails (a full disk, a missing face
+file, ...) is reported and left unfinished, so it is done again and merged
+by the next run. Units that were already merged into
+annotation.txt are skipped, so remove the output directory (or at least
+annotation.txt and annotation_shards/) to regenerate haggling data.
 
 Final data cleanup and deskewing
 ================================
@@ -64,10 +88,12 @@ and stored in the panoptic dataset root.
 import cv2
 import os
 import json
+import shutil
+import argparse
+import multiprocessing
 import numpy as np
-from utils import projectPoints, align, rotationMatrixToEulerAngles2, reference_head, get_sphere, select_euler, inverse_rotate_zyx
+from utils import projectPoints, align_batch, rotationMatrixToEulerAngles2, reference_head, get_sphere, select_euler, inverse_rotate_zyx
 from PIL import Image
-import matplotlib.pyplot as plt
 
 model_points, _ = reference_head(scale=1, pyr=(0., 0., 0.))
 kp_idx=np.asarray([17, 21, 26, 22, 45, 42, 39, 36, 35, 31, 54, 48, 57, 8])
@@ -87,7 +113,29 @@ def last_8chars(x):
     return(x)
 without_top = [0, 3, 5, 8, 9, 11, 12, 14, 15, 16, 18, 20, 21, 22, 23, 24, 25, 26, 27, 29]
 
-def save_img_head(frame, save_path, seq, cam, cam_id, json_file, frame_id, threshold, yaw_ref):
+def face_geometry(json_file):
+    '''Aligns the reference head to every face of a hdFace3d file with enough confident landmarks.
+    The alignment does not depend on the camera, returns a list of (rotation, translation, helmet points)'''
+    with open(json_file) as dfile:
+        fframe = json.load(dfile)
+    if not fframe['people']:
+        return []
+    # 3D Face has 70 3D joints, stored as an array [x1,y1,z1,x2,y2,z2,...]
+    face3d = np.stack([np.array(face['face70']['landmarks']).reshape((-1, 3)).transpose()[:, kp_idx]
+                       for face in fframe['people']])
+    face_conf = np.stack([np.asarray(face['face70']['averageScore'])[kp_idx] for face in fframe['people']])
+    clean_match = (face_conf > 0.1) #only pick points confidence higher than 0.1
+    valid = clean_match.sum(1) > 6
+    if not valid.any():
+        return []
+    model = np.broadcast_to(model_points.astype(np.float32)[:, kp_idx_model], face3d[valid].shape)
+    rotation, translation, error, scale = align_batch(model, face3d[valid], clean_match[valid])
+    sphere_new = scale[:, None, None] * rotation @ sphere + translation
+    return [(np.mat(r), t, p) for r, t, p in zip(rotation, translation, sphere_new)]
+
+def save_faces(frame, save_path, seq, cam, cam_id, faces, frame_id, threshold, yaw_ref, anno_path=None, writer=None):
+    '''Projects the face_geometry faces into one camera and saves the head crops, the annotation
+    lines go to writer (an AnnotationWriter) if given, else are appended to anno_path'''
     img_path = os.path.join(save_path, seq)
     frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
     frame = Image.fromarray(frame)
@@ -100,78 +148,70 @@ def save_img_head(frame, save_path, seq, cam, cam_id, json_file, frame_id, thres
     cam['distCoef'] = np.array(cam['distCoef'])
     cam['R'] = np.mat(cam['R'])
     cam['t'] = np.array(cam['t']).reshape((3, 1))
-    with open(json_file) as dfile:
-        fframe = json.load(dfile)
-        count_face = -1
-        yaw_avg = 0
-    for face in fframe['people']:
-        # 3D Face has 70 3D joints, stored as an array [x1,y1,z1,x2,y2,z2,...]
-        face3d = np.array(face['face70']['landmarks']).reshape((-1, 3)).transpose()
-        face_conf = np.asarray(face['face70']['averageScore'])
-        model_points_3D = np.ones((4, 58), dtype=np.float32)
-        model_points_3D[0:3] = model_points
-        clean_match = (face_conf[kp_idx] > 0.1) #only pick points confidence higher than 0.1
-        kp_idx_clean = kp_idx[clean_match]
-        kp_idx_model_clean = kp_idx_model[clean_match]
-        if(len(kp_idx_clean)>6):
-            count_face += 1
-            rotation, translation, error, scale = align(np.mat(model_points_3D[0:3, kp_idx_model_clean]),
-                                                        np.mat(face3d[:, kp_idx_clean]))
-            sphere_new = scale * rotation @ (sphere) + translation
-            pt_helmet = projectPoints(sphere_new,
-                                               cam['K'], cam['R'], cam['t'],
-                                               cam['distCoef'])
-            temp = np.zeros((4, 4))
-            temp[0:3, 0:3] = rotation
-            temp[0:3, 3:4] = translation
-            temp[3, 3] = 1
-            E_virt = np.linalg.inv(temp @ np.linalg.inv(E_ref))
-            E_real = np.zeros((4, 4))
-            E_real[0:3, 0:3] = cam['R']
-            E_real[0:3, 3:4] = cam['t']
-            E_real[3, 3] = 1
-
-            compound = E_real @ np.linalg.inv(E_virt)
-            status, [pitch, yaw, roll] = select_euler(np.rad2deg(inverse_rotate_zyx(compound)))
-            yaw= -yaw
-            roll = -roll
-            yaw_avg = yaw_avg+yaw
-            if(abs(yaw-yaw_ref)>threshold or yaw_ref==-999):
-                if (status == True):
-                    x_min = int(max(min(pt_helmet[0, :]),0))
-                    y_min = int(max(min(pt_helmet[1, :]),0))
-                    x_max = int(min(max(pt_helmet[0, :]), frame.size[0]))
-                    y_max = int(min(max(pt_helmet[1, :]),frame.size[1]))
-                    # print(x_min, y_min, x_max, y_max)
-                    if(x_min<x_max and y_min<y_max and abs(x_min-x_max)< frame.size[0]): #some sanity check
-                        h = y_max-y_min
-                        w = x_max-x_min
-                        if not(h/w > 2 or w/h >2): #eleminate those too wide or too narrow
-                            img = frame.crop((x_min, y_min, x_max, y_max))
-                            # draw = ImageDraw.Draw(img)
-                            # draw.text((0, 10), "yaw: {}".format(round(yaw)), (0, 255, 255))
-                            # draw.text((0, 0), "pitch: {}".format(round(pitch)), (0, 255, 255))
-                            # draw.text((0, 20), "roll: {}".format(round(roll)), (0, 255, 255))
-                            # plt.imshow(img)
-                            # plt.show()
-                            filename = '{0:02d}_{1:01d}_{2:08d}.jpg'.format(cam_id, count_face, frame_id)
-                            if not (os.path.exists(img_path)):
+    yaw_avg = 0
+    for count_face, (rotation, translation, sphere_new) in enumerate(faces):
+        pt_helmet = projectPoints(sphere_new,
+                                           cam['K'], cam['R'], cam['t'],
+                                           cam['distCoef'])
+        temp = np.zeros((4, 4))
+        temp[0:3, 0:3] = rotation
+        temp[0:3, 3:4] = translation
+        temp[3, 3] = 1
+        E_virt = np.linalg.inv(temp @ np.linalg.inv(E_ref))
+        E_real = np.zeros((4, 4))
+        E_real[0:3, 0:3] = cam['R']
+        E_real[0:3, 3:4] = cam['t']
+        E_real[3, 3] = 1
+
+        compound = E_real @ np.linalg.inv(E_virt)
+        status, [pitch, yaw, roll] = select_euler(np.rad2deg(inverse_rotate_zyx(compound)))
+        yaw= -yaw
+        roll = -roll
+        yaw_avg = yaw_avg+yaw
+        if(abs(yaw-yaw_ref)>threshold or yaw_ref==-999):
+            if (status == True):
+                x_min = int(max(min(pt_helmet[0, :]),0))
+                y_min = int(max(min(pt_helmet[1, :]),0))
+                x_max = int(min(max(pt_helmet[0, :]), frame.size[0]))
+                y_max = int(min(max(pt_helmet[1, :]),frame.size[1]))
+                # print(x_min, y_min, x_max, y_max)
+                if(x_min<x_max and y_min<y_max and abs(x_min-x_max)< frame.size[0]): #some sanity check
+                    h = y_max-y_min
+                    w = x_max-x_min
+                    if not(h/w > 2 or w/h >2): #eleminate those too wide or too narrow
+                        img = frame.crop((x_min, y_min, x_max, y_max))
+                        # draw = ImageDraw.Draw(img)
+                        # draw.text((0, 10), "yaw: {}".format(round(yaw)), (0, 255, 255))
+                        # draw.text((0, 0), "pitch: {}".format(round(pitch)), (0, 255, 255))
+                        # draw.text((0, 20), "roll: {}".format(round(roll)), (0, 255, 255))
+                        # plt.imshow(img)
+                        # plt.show()
+                        filename = '{0:02d}_{1:01d}_{2:08d}.jpg'.format(cam_id, count_face, frame_id)
+                        if not (os.path.exists(img_path)):
+                            try:
                                 os.mkdir(img_path)
-                            file_path = os.path.join(img_path, filename)
-                            img.save(file_path, "JPEG")
-                            anno_path = os.path.join(save_path, "annotation.txt")
-                            line = seq+'/'+filename + ','+str(yaw)+','+str(pitch)+','+str(roll)+'\n'
+                            except OSError: # created by another worker in the meantime
+                                pass
+                        file_path = os.path.join(img_path, filename)
+                        img.save(file_path, "JPEG")
+                        line = seq+'/'+filename + ','+str(yaw)+','+str(pitch)+','+str(roll)+'\n'
+                        if writer is not None:
+                            writer.write(line)
+                        else:
+                            if anno_path is None:
+                                anno_path = os.path.join(save_path, "annotation.txt")
                             with open(anno_path, "a") as f:
                                 f.write(line)
-    if count_face!=-1:
-        return yaw_avg/(count_face+1)
+    if faces:
+        return yaw_avg/len(faces)
     else:
         return -999
 
-def sample_video(root_path, sequence_name, save_path, thresh=5, interval=10):
-    video_path = os.path.join(root_path, sequence_name, 'hdVideos')
+def save_img_head(frame, save_path, seq, cam, cam_id, json_file, frame_id, threshold, yaw_ref, anno_path=None, writer=None):
+    return save_faces(frame, save_path, seq, cam, cam_id, face_geometry(json_file), frame_id, threshold, yaw_ref, anno_path, writer)
+
+def load_sequence(root_path, sequence_name):
     json_path = os.path.join(root_path, sequence_name, 'hdFace3d')
-    # save_path = os.path.join(save_path, sequence_name)
     file_list = os.listdir(json_path)
     json_list = []
 
@@ -183,32 +223,286 @@ def sample_video(root_path, sequence_name, save_path, thresh=5, interval=10):
         json_list.append(os.path.join(json_path, filename))
     start_frame = int(json_list[0][-12:].split(".")[0])
     end_frame = int(json_list[-1][-12:].split(".")[0])
+    return json_list, start_frame, end_frame, cameras
+
+def read_sparse(cap, frame_ids):
+    '''Yields (frame_id, frame) for the increasing video frame indices frame_ids. The frames in
+    between are only grabbed, not decoded, which keeps the index of every frame exact (seeking
+    with CAP_PROP_POS_FRAMES lands on keyframes and can be off by a few frames in mp4).'''
+    count = -1
+    for frame_id in frame_ids:
+        while count < frame_id - 1:
+            if not cap.grab():
+                return
+            count += 1
+        ret, frame = cap.read()
+        if not ret:
+            return
+        count += 1
+        yield frame_id, frame
+
+def read_manifest(manifest_path):
+    '''(last, offset, finished, merging, merged) of a manifest, last is (frame_id, yaw_prev) of the
+    last finished frame or None, offset the size of the shard after that frame and merging the size
+    annotation.txt had before the shard was appended to it, or None'''
+    last, offset, finished, merging, merged = None, 0, False, None, False
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r+') as f:
+            text = f.read()
+            complete = text[:text.rfind('\n') + 1]
+            if len(complete) < len(text):
+                # the last record was cut short by a crash, drop it so the next one starts on its own line
+                f.truncate(len(complete))
+            for record in complete.split():
+                if record == 'end':
+                    finished = True
+                elif record == 'merged':
+                    merged = True
+                elif record.startswith('merging,'):
+                    merging = int(record.split(',')[1])
+                else:
+                    frame_id, yaw_prev, offset = record.split(',')
+                    last, offset = (int(frame_id), float(yaw_prev)), int(offset)
+    return last, offset, finished, merging, merged
+
+class AnnotationWriter(object):
+    '''Annotation lines of one (sequence, camera) unit, written to its shard in bulk.
+
+    Lines of a frame are kept until frame_done, and every flush appends the last finished frame,
+    the camera's yaw_prev and the shard size to the manifest next to the shard. Opening the writer
+    again cuts the shard back to the last manifest record, so the unit resumes after that frame.'''
+    def __init__(self, path, buffer_lines=256, buffer_frames=50):
+        self.path = path
+        self.manifest_path = os.path.splitext(path)[0] + '.manifest'
+        self.buffer_lines = buffer_lines
+        self.buffer_frames = buffer_frames
+        self.last, offset, self.finished, _, merged = read_manifest(self.manifest_path)
+        self.finished = self.finished or merged
+        self.frame_lines = []
+        self.lines = []
+        self.frames = 0
+        self.f = None
+        if not self.finished:
+            self.f = open(path, 'a')
+            self.f.truncate(offset) # lines written after the last record are written again
+            self.f.seek(offset)
+
+    def write(self, line):
+        self.frame_lines.append(line)
+
+    def frame_done(self, frame_id, yaw_prev):
+        self.lines.extend(self.frame_lines)
+        self.frame_lines = []
+        self.last = (frame_id, yaw_prev)
+        self.frames += 1
+        if len(self.lines) >= self.buffer_lines or self.frames >= self.buffer_frames:
+            self.flush()
+
+    def flush(self):
+        if self.f is None:
+            return
+        if self.lines:
+            self.f.write(''.join(self.lines))
+            self.f.flush()
+            self.lines = []
+        if self.frames:
+            with open(self.manifest_path, 'a') as m:
+                m.write('{},{!r},{}\n'.format(self.last[0], float(self.last[1]), self.f.tell()))
+            self.frames = 0
+
+    def close(self, finished=False):
+        '''finished marks the whole unit as done, a rerun skips it. The lines of a frame that was
+        not finished are dropped, the frame is done again (crops included) when the unit resumes.'''
+        if self.f is None:
+            return
+        self.frame_lines = []
+        self.flush()
+        self.f.close()
+        self.f = None
+        if finished:
+            with open(self.manifest_path, 'a') as m:
+                m.write('end\n')
+            self.finished = True
+
+def sample_camera(root_path, sequence_name, cam_idx, save_path, thresh=5, interval=10, anno_path=None, writer=None):
+    '''Head crops of every interval-th frame of one camera. With an AnnotationWriter the frames
+    it already has are skipped and the camera is marked as finished at the end.'''
+    if writer is not None and writer.finished:
+        return
+    video_path = os.path.join(root_path, sequence_name, 'hdVideos')
+    json_list, start_frame, end_frame, cameras = load_sequence(root_path, sequence_name)
+    clip = 'hd_00_{0:02d}.mp4'.format(cam_idx)
+    video_clip = os.path.join(video_path, clip)
+    cap = cv2.VideoCapture(video_clip)
+    yaw_prev = -999 #initial value
+    frame_ids = range(start_frame, end_frame, interval)
+    if writer is not None and writer.last is not None:
+        frame_ids = range(writer.last[0] + interval, end_frame, interval)
+        yaw_prev = writer.last[1]
+    # video frame i is json_list[i - start_frame]
+    for frame_id, frame in read_sparse(cap, frame_ids):
+        try:
+            if not (frame==frame[0,0]).all():
+                yaw_prev = save_img_head(frame, save_path, sequence_name, cameras[(0, cam_idx)], cam_idx, json_list[frame_id-start_frame], frame_id, thresh, yaw_prev, anno_path, writer)
+        except Exception as e:
+            # the camera is left unfinished, the next run does it again from its last manifest record
+            print('{} camera {} frame {} failed: {!r}'.format(sequence_name, cam_idx, frame_id, e))
+            cap.release()
+            return
+        if writer is not None:
+            writer.frame_done(frame_id, yaw_prev)
+    cap.release()
+    if writer is not None:
+        writer.close(finished=True)
+
+def sample_sequence(root_path, sequence_name, save_path, thresh=5, interval=10, cam_list=without_top, anno_paths=None, writers=None):
+    '''sample_camera of all cameras in cam_list, frame by frame: each face file is parsed and its faces
+    aligned once, then projected into every camera. writers maps a camera to its AnnotationWriter,
+    without them one is opened on anno_paths[camera] (default the camera's shard) and closed here.'''
+    if writers is None:
+        writers = {cam_idx: AnnotationWriter(anno_paths[cam_idx] if anno_paths else shard_path(save_path, sequence_name, cam_idx))
+                   for cam_idx in cam_list}
+        try:
+            return sample_sequence(root_path, sequence_name, save_path, thresh, interval, cam_list, writers=writers)
+        finally:
+            for writer in writers.values():
+                writer.close()
+    video_path = os.path.join(root_path, sequence_name, 'hdVideos')
+    json_list, start_frame, end_frame, cameras = load_sequence(root_path, sequence_name)
+    frame_ids = range(start_frame, end_frame, interval)
+    caps = {}
+    readers = {}
+    yaw_prev = {}
+    for cam_idx in cam_list:
+        writer = writers[cam_idx]
+        if writer.finished:
+            continue
+        cam_frame_ids = frame_ids
+        yaw_prev[cam_idx] = -999 #initial value
+        if writer.last is not None:
+            cam_frame_ids = range(writer.last[0] + interval, end_frame, interval)
+            yaw_prev[cam_idx] = writer.last[1]
+        caps[cam_idx] = cv2.VideoCapture(os.path.join(video_path, 'hd_00_{0:02d}.mp4'.format(cam_idx)))
+        readers[cam_idx] = (cam_frame_ids, read_sparse(caps[cam_idx], cam_frame_ids))
+    try:
+        for frame_id in frame_ids:
+            if not readers:
+                break
+            faces = None
+            for cam_idx in list(readers):
+                cam_frame_ids, reader = readers[cam_idx]
+                if frame_id < cam_frame_ids.start: # done in an earlier run
+                    continue
+                item = next(reader, None)
+                if item is None: # end of this video
+                    del readers[cam_idx]
+                    caps[cam_idx].release()
+                    writers[cam_idx].close(finished=True)
+                    continue
+                try:
+                    frame = item[1]
+                    if not (frame==frame[0,0]).all():
+                        if faces is None:
+                            faces = face_geometry(json_list[frame_id-start_frame])
+                        yaw_prev[cam_idx] = save_faces(frame, save_path, sequence_name, cameras[(0, cam_idx)], cam_idx, faces, frame_id,
+                                                       thresh, yaw_prev[cam_idx], writer=writers[cam_idx])
+                except Exception as e:
+                    # the camera is left unfinished, the next run does it again from its last manifest record
+                    print('{} camera {} frame {} failed: {!r}'.format(sequence_name, cam_idx, frame_id, e))
+                    del readers[cam_idx]
+                    caps[cam_idx].release()
+                    writers[cam_idx].close()
+                    continue
+                writers[cam_idx].frame_done(frame_id, yaw_prev[cam_idx])
+        for cam_idx in readers:
+            writers[cam_idx].close(finished=True)
+    finally:
+        for cap in caps.values():
+            cap.release()
+
+def sample_video(root_path, sequence_name, save_path, thresh=5, interval=10, frame_major=False):
+    json_list, start_frame, end_frame, _ = load_sequence(root_path, sequence_name)
     for i in range(start_frame, end_frame, interval):
         print(json_list[i-start_frame])
     print(start_frame, end_frame)
 
-    for i in without_top: #0 to 30 hd cameras
-        clip = 'hd_00_{0:02d}.mp4'.format(i)
-        video_clip = os.path.join(video_path, clip)
-        cap = cv2.VideoCapture(video_clip)
-        ret, frame = cap.read()
-        count = 0
-        frame_id = start_frame
-        # frame_id = 10921
-        yaw_prev = -999 #initial value
-        while frame_id<end_frame:
-            ret, frame = cap.read()
-            count+=1
-            if(count==frame_id):
-                # print('i',i)
-                # print('json',frame_id-start_frame)
-                #print('{}: {}'.format(sequence_name,frame_id))
-                try:
-                    if not (frame==frame[0,0]).all():
-                        yaw_prev = save_img_head(frame, save_path, sequence_name, cameras[(0, i)],i, json_list[frame_id-start_frame], frame_id, thresh, yaw_prev)
-                    frame_id = frame_id + interval
-                except:
-                    break
+    os.makedirs(os.path.join(save_path, 'annotation_shards'), exist_ok=True)
+    if frame_major:
+        _sample_sequence_unit((root_path, sequence_name, save_path, thresh, interval))
+    else:
+        for i in without_top: #0 to 30 hd cameras
+            _sample_unit((root_path, sequence_name, i, save_path, thresh, interval))
+    merge_shards(save_path, [(sequence_name, i) for i in without_top])
+
+def shard_path(save_path, sequence_name, cam_idx):
+    return os.path.join(save_path, 'annotation_shards', '{}_{:02d}.txt'.format(sequence_name, cam_idx))
+
+def _init_worker():
+    # one process per core already, opencv should not spawn threads on top
+    cv2.setNumThreads(1)
+
+def _sample_unit(unit):
+    root_path, sequence_name, cam_idx, save_path, thresh, interval = unit
+    writer = AnnotationWriter(shard_path(save_path, sequence_name, cam_idx))
+    try:
+        sample_camera(root_path, sequence_name, cam_idx, save_path, thresh, interval, writer=writer)
+    finally:
+        writer.close()
+    return sequence_name, cam_idx
+
+def _sample_sequence_unit(unit):
+    root_path, sequence_name, save_path, thresh, interval = unit
+    sample_sequence(root_path, sequence_name, save_path, thresh, interval)
+    return sequence_name, None
+
+def merge_shards(save_path, units):
+    '''Append the shards of finished units to annotation.txt in unit order and remove them, their
+    manifests are marked as merged so that running the same units again adds nothing. The size of
+    annotation.txt is recorded before a shard is copied, a merge that was cut short is undone on
+    the next run and the shard is appended again.'''
+    anno_path = os.path.join(save_path, "annotation.txt")
+    for sequence_name, cam_idx in units:
+        shard = shard_path(save_path, sequence_name, cam_idx)
+        manifest = os.path.splitext(shard)[0] + '.manifest'
+        _, _, finished, merging, merged = read_manifest(manifest)
+        if merged or not finished:
+            continue
+        with open(anno_path, "a") as f:
+            if merging is None:
+                with open(manifest, 'a') as m:
+                    m.write('merging,{}\n'.format(f.tell()))
+            else:
+                f.truncate(merging)
+            if os.path.exists(shard):
+                with open(shard) as s:
+                    shutil.copyfileobj(s, f)
+        with open(manifest, 'a') as m:
+            m.write('merged\n')
+        if os.path.exists(shard):
+            os.remove(shard)
+
+def sample_videos_parallel(root_path, sequence_names, save_path, workers=None, thresh=5, interval=10, frame_major=False):
+    '''sample_video of every sequence, with the (sequence, camera) units spread over a process pool.
+    With frame_major a unit is a whole sequence run through sample_sequence.'''
+    units = [(sequence_name, cam_idx) for sequence_name in sequence_names for cam_idx in without_top]
+    os.makedirs(os.path.join(save_path, 'annotation_shards'), exist_ok=True)
+    for sequence_name in sequence_names:
+        os.makedirs(os.path.join(save_path, sequence_name), exist_ok=True)
+    pool = multiprocessing.Pool(workers, initializer=_init_worker)
+    try:
+        if frame_major:
+            tasks = [(root_path, sequence_name, save_path, thresh, interval) for sequence_name in sequence_names]
+            results = pool.imap_unordered(_sample_sequence_unit, tasks)
+        else:
+            tasks = [(root_path, sequence_name, cam_idx, save_path, thresh, interval) for sequence_name, cam_idx in units]
+            results = pool.imap_unordered(_sample_unit, tasks)
+        for done, (sequence_name, cam_idx) in enumerate(results):
+            print('{}/{} {} {} done'.format(done + 1, len(tasks), sequence_name,
+                                            'all cameras' if cam_idx is None else 'camera {}'.format(cam_idx)))
+    finally:
+        pool.close()
+        pool.join()
+    merge_shards(save_path, units)
 
 def mtc_dataset(root_path, sequence_name, save_path, thresh=5):
     img_path = os.path.join(root_path, 'hdImgs', sequence_name)
@@ -245,24 +539,33 @@ def mtc_dataset(root_path, sequence_name, save_path, thresh=5):
 
 
 if __name__ == '__main__':
-    root = '/home/tmp/panoptic-toolbox'
-    out_path = os.path.dirname(os.path.abspath(__file__))+'/data/pre_process'
+    vid_seq_list =['170404_haggling_a1','170404_haggling_a2','170404_haggling_a3','170404_haggling_b1','170404_haggling_b2','170404_haggling_b3','170407_haggling_a1','170407_haggling_a2','170407_haggling_a3','170407_haggling_b1','170407_haggling_b2','170407_haggling_b3']
+    parser = argparse.ArgumentParser(description='prepare panoptic head pose training data')
+    parser.add_argument('--root', type=str, default='/home/tmp/panoptic-toolbox', help='panoptic data root with the sequences')
+    parser.add_argument('--output', type=str, default=os.path.dirname(os.path.abspath(__file__))+'/data/pre_process', help='output directory')
+    parser.add_argument('--mtc', action='store_true', help='process mtc range of motion data instead of haggling')
+    parser.add_argument('--sequences', type=str, nargs='+', default=vid_seq_list[0:8], help='haggling sequences to process')
+    parser.add_argument('--interval', type=int, default=10, help='sample every interval-th frame')
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help='worker processes, 1 runs serially')
+    parser.add_argument('--frame_major', action='store_true', help='parse and align each face file once for all cameras')
+    args = parser.parse_args()
+    root = args.root
+    out_path = args.output
     try:
         os.makedirs( out_path )
     except:
         pass
 
-    do_mtc = False
-
-    if do_mtc:
+    if args.mtc:
         seq_list = ['171026_pose1', '171026_pose2', '171026_pose3', '171204_pose1', '171204_pose2', '171204_pose3', '171204_pose4', '171204_pose5', '171204_pose6']
         for i in range(0,1):
             mtc_dataset(root, seq_list[i], out_path)
+    elif args.workers > 1:
+        sample_videos_parallel(root, args.sequences, out_path, args.workers, interval=args.interval, frame_major=args.frame_major)
     else:
-        vid_seq_list =['170404_haggling_a1','170404_haggling_a2','170404_haggling_a3','170404_haggling_b1','170404_haggling_b2','170404_haggling_b3','170407_haggling_a1','170407_haggling_a2','170407_haggling_a3','170407_haggling_b1','170407_haggling_b2','170407_haggling_b3']
-        for i in range(0,8):
+        for sequence_name in args.sequences:
             try:
-                os.path.makedirs( out_path + '/' + vid_seq_list[i] )
+                os.makedirs( out_path + '/' + sequence_name )
             except:
                 pass
-            sample_video(root,vid_seq_list[i], out_path, interval=10)
\ No newline at end of file
+            sample_video(root, sequence_name, out_path, interval=args.interval, frame_major=args.frame_major)
\ No newline at end of file
@@ -0,0 +1,125 @@
+'''
+Post-training int8 quantization of WHENet for CPU / edge deployment.
+
+Calibration crops are read from a directory in either of the formats used in
+this repo:
+
+    bbox.txt        demo format, image_name,x_min y_min x_max y_max[,...]
+    annotation.txt  prepare_images.py format, seq/image_name,yaw,pitch,roll
+                    (already cropped heads, the labels are used for the report)
+
+The quantized model is written as .tflite and can be loaded with
+WHENet(snapshot='WHENet_int8.tflite'). Afterwards yaw/pitch/roll MAE and
+latency of the int8 model are reported against the float model, and against
+the labels when the calibration set has them:
+
+    python quantize.py --snapshot WHENet.h5 --calib_dir Sample/ --output WHENet_int8.tflite
+
+Full integer quantization with calibration needs TensorFlow >= 1.14. With
+older versions (requirements.txt pins 1.12) only the weights are quantized to
+int8 and activations stay float.
+'''
+import os
+import json
+import argparse
+from timeit import default_timer as timer
+import numpy as np
+import cv2
+from keras import backend as K
+from whenet import WHENet, lite_module, IMAGENET_MEAN, IMAGENET_STD
+from utils import RoiCropper
+from batch_infer import read_bbox_file
+
+def load_calibration(calib_dir, limit=None):
+    '''Returns (N,224,224,3) uint8 RGB crops and (N,3) yaw, pitch, roll labels or None'''
+    crops, labels = [], []
+    if os.path.isfile(os.path.join(calib_dir, 'bbox.txt')):
+        for filename, boxes in read_bbox_file(os.path.join(calib_dir, 'bbox.txt')):
+            img = cv2.imread(os.path.join(calib_dir, filename))
+            if img is None:
+                continue
+            crops.extend(RoiCropper(capacity=len(boxes))(img, boxes))
+            if limit and len(crops) >= limit:
+                break
+    elif os.path.isfile(os.path.join(calib_dir, 'annotation.txt')):
+        with open(os.path.join(calib_dir, 'annotation.txt')) as f:
+            for line in f:
+                filename, yaw, pitch, roll = line.strip().split(',')
+                img = cv2.imread(os.path.join(calib_dir, filename))
+                if img is None:
+                    continue
+                crops.append(cv2.cvtColor(cv2.resize(img, (224, 224)), cv2.COLOR_BGR2RGB))
+                labels.append([float(yaw), float(pitch), float(roll)])
+                if limit and len(crops) >= limit:
+                    break
+    else:
+        raise IOError('no bbox.txt or annotation.txt in {}'.format(calib_dir))
+    crops = np.array(crops[:limit], dtype=np.uint8).reshape(-1, 224, 224, 3)
+    return crops, np.array(labels[:limit], dtype=np.float32) if labels else None
+
+def quantize(whenet, crops, output):
+    model = whenet.base_model
+    lite = lite_module()
+    converter = lite.TFLiteConverter.from_session(K.get_session(), [model.input], model.outputs)
+    if hasattr(converter, 'representative_dataset'):
+        def representative_dataset():
+            for crop in crops:
+                yield [((crop[None].astype(np.float32) / 255. - IMAGENET_MEAN) / IMAGENET_STD).astype(np.float32)]
+        converter.optimizations = [lite.Optimize.DEFAULT]
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [lite.OpsSet.TFLITE_BUILTINS_INT8]
+        mode = 'int8 weights and activations'
+    else:
+        # TF < 1.14 has no calibration based quantization
+        converter.post_training_quantize = True
+        mode = 'int8 weights only'
+    with open(output, 'wb') as f:
+        f.write(converter.convert())
+    print('{} written ({}, {:.1f} MB)'.format(output, mode, os.path.getsize(output) / 2.**20))
+
+def angle_mae(a, b):
+    diff = np.abs(a - b)
+    diff[:, 0] = np.minimum(diff[:, 0], 360. - diff[:, 0]) # yaw wraps around
+    return dict(zip(('yaw', 'pitch', 'roll'), diff.mean(axis=0).tolist()))
+
+def latency_ms(model, crops, iters=20):
+    model.get_angles(crops[:1])
+    tic = timer()
+    for i in range(iters):
+        model.get_angles(crops[i % len(crops)][None])
+    return 1000. * (timer() - tic) / iters
+
+def report(float_model, int8_model, crops, labels):
+    float_angles = float_model.get_angles(crops)
+    int8_angles = int8_model.get_angles(crops)
+    result = {
+        'num_crops': len(crops),
+        'int8_vs_float_mae': angle_mae(int8_angles, float_angles),
+        'float_latency_ms': latency_ms(float_model, crops),
+        'int8_latency_ms': latency_ms(int8_model, crops),
+    }
+    if labels is not None:
+        result['float_vs_label_mae'] = angle_mae(float_angles, labels)
+        result['int8_vs_label_mae'] = angle_mae(int8_angles, labels)
+    return result
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='post-training int8 quantization of whenet')
+    parser.add_argument('--snapshot', type=str, default='WHENet.h5', help='float whenet snapshot path')
+    parser.add_argument('--calib_dir', type=str, default='Sample/', help='directory with bbox.txt or annotation.txt and the images')
+    parser.add_argument('--num_calib', type=int, default=500, help='max number of calibration crops')
+    parser.add_argument('--eval_dir', type=str, default=None, help='crops for the accuracy report, defaults to calib_dir')
+    parser.add_argument('--output', type=str, default='WHENet_int8.tflite', help='quantized model path')
+    parser.add_argument('--report', type=str, default=None, help='optional json path for the accuracy / latency report')
+    args = parser.parse_args()
+
+    float_model = WHENet(snapshot=args.snapshot, uint8_input=True)
+    crops, _ = load_calibration(args.calib_dir, args.num_calib)
+    quantize(float_model, crops, args.output)
+
+    eval_crops, labels = load_calibration(args.eval_dir or args.calib_dir)
+    result = report(float_model, WHENet(snapshot=args.output, uint8_input=True), eval_crops, labels)
+    print(json.dumps(result, indent=2))
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(result, f, indent=2)
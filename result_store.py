@@ -0,0 +1,194 @@
+'''
+Compact columnar store of head pose results for long recordings.
+
+A store is a directory with one .npy file per column, holding one row per head,
+and an index with one row per processed frame:
+
+    frame.npy track.npy box.npy score.npy yaw.npy pitch.npy roll.npy
+    index.npy   (frame, timestamp, start, count), rows start:start+count are the frame's heads
+
+ResultWriter appends in fixed size chunks, so recording needs constant memory
+however long the video is. ResultStore memory-maps the columns, and frame or
+time ranges are sliced through the index without reading the rest:
+
+    python result_store.py --video IMG_0176.mp4 --store results/
+
+    store = ResultStore('results/')
+    heads = store.time_range(3600., 3660.)   # dict of column arrays for one minute
+'''
+import os
+import json
+import argparse
+import numpy as np
+
+COLUMNS = (('frame', np.int64, ()), ('track', np.int32, ()), ('box', np.float32, (4,)), ('score', np.float32, ()),
+           ('yaw', np.float32, ()), ('pitch', np.float32, ()), ('roll', np.float32, ()))
+RECORD_DTYPE = np.dtype([(name, dtype, shape) for name, dtype, shape in COLUMNS])
+INDEX_DTYPE = np.dtype([('frame', np.int64), ('timestamp', np.float64), ('start', np.int64), ('count', np.int32)])
+
+class NpyAppender(object):
+    '''.npy file grown by appending rows, the header is rewritten with the row count on every flush
+    so the file is readable while it is still being written'''
+    HEADER_LEN = 256
+
+    def __init__(self, path, dtype, shape=()):
+        self.f = open(path, 'wb')
+        self.dtype = np.dtype(dtype)
+        self.shape = tuple(shape)
+        self.count = 0
+        self._write_header()
+
+    def _write_header(self):
+        header = "{{'descr': {}, 'fortran_order': False, 'shape': {}, }}".format(
+            repr(np.lib.format.dtype_to_descr(self.dtype)), (self.count,) + self.shape)
+        header = header.ljust(self.HEADER_LEN - 10 - 1) + '\n'
+        self.f.seek(0)
+        self.f.write(b'\x93NUMPY\x01\x00' + np.uint16(len(header)).tobytes() + header.encode('latin1'))
+        self.f.seek(0, os.SEEK_END)
+
+    def write(self, rows):
+        self.f.write(np.ascontiguousarray(rows, dtype=self.dtype).tobytes())
+        self.count += len(rows)
+
+    def flush(self):
+        self._write_header()
+        self.f.flush()
+
+    def close(self):
+        self.flush()
+        self.f.close()
+
+class ResultWriter(object):
+    '''Appends per frame results to a store directory, buffer_rows heads / frames are kept in memory'''
+    def __init__(self, path, buffer_rows=4096, meta=None):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.files = {name: NpyAppender(os.path.join(path, name + '.npy'), dtype, shape) for name, dtype, shape in COLUMNS}
+        self.index_file = NpyAppender(os.path.join(path, 'index.npy'), INDEX_DTYPE)
+        self.buffer = np.zeros(buffer_rows, dtype=RECORD_DTYPE)
+        self.index = np.zeros(buffer_rows, dtype=INDEX_DTYPE)
+        self.filled = 0
+        self.frames = 0
+        self.rows = 0
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta or {}, f)
+
+    def append(self, frame, timestamp, boxes, scores, angles, track_ids=None):
+        '''boxes (N,4), scores (N,), angles (N,3) yaw, pitch, roll of the heads of one frame'''
+        n = len(boxes)
+        if self.frames == len(self.index):
+            self.flush()
+        self.index[self.frames] = (frame, timestamp, self.rows, n)
+        self.frames += 1
+        self.rows += n
+        angles = np.asarray(angles, dtype=np.float32).reshape(-1, 3)
+        track_ids = np.full(n, -1) if track_ids is None else track_ids
+        start = 0
+        while start < n:
+            if self.filled == len(self.buffer):
+                self._flush_rows()
+            m = min(n - start, len(self.buffer) - self.filled)
+            rows = self.buffer[self.filled:self.filled + m]
+            rows['frame'] = frame
+            rows['track'] = track_ids[start:start + m]
+            rows['box'] = boxes[start:start + m]
+            rows['score'] = scores[start:start + m]
+            rows['yaw'], rows['pitch'], rows['roll'] = angles[start:start + m].T
+            self.filled += m
+            start += m
+
+    def _flush_rows(self):
+        for name, f in self.files.items():
+            f.write(self.buffer[name][:self.filled])
+        self.filled = 0
+
+    def flush(self):
+        self._flush_rows()
+        self.index_file.write(self.index[:self.frames])
+        self.frames = 0
+        for f in list(self.files.values()) + [self.index_file]:
+            f.flush()
+
+    def close(self):
+        self.flush()
+        for f in list(self.files.values()) + [self.index_file]:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ResultStore(object):
+    '''Read access to a store directory, columns are memory-mapped'''
+    def __init__(self, path):
+        self.path = path
+        self.index = np.load(os.path.join(path, 'index.npy'))
+        self.columns = {name: self._load(name) for name, _, _ in COLUMNS}
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.meta = json.load(f)
+
+    def _load(self, name):
+        path = os.path.join(self.path, name + '.npy')
+        # an empty file can not be memory-mapped
+        return np.load(path, mmap_mode='r') if os.path.getsize(path) > NpyAppender.HEADER_LEN else np.load(path)
+
+    def __len__(self):
+        return len(self.columns['frame'])
+
+    def rows(self, start, stop):
+        '''dict of column views of rows start:stop'''
+        return {name: column[start:stop] for name, column in self.columns.items()}
+
+    def records(self, start, stop):
+        '''rows start:stop copied into a RECORD_DTYPE array'''
+        records = np.zeros(stop - start, dtype=RECORD_DTYPE)
+        for name, column in self.columns.items():
+            records[name] = column[start:stop]
+        return records
+
+    def _index_rows(self, first, last):
+        if first >= last:
+            return 0, 0
+        return int(self.index['start'][first]), int(self.index['start'][last - 1] + self.index['count'][last - 1])
+
+    def frame_range(self, first_frame, stop_frame):
+        '''Heads of the frames first_frame <= frame < stop_frame'''
+        first, last = np.searchsorted(self.index['frame'], [first_frame, stop_frame])
+        return self.rows(*self._index_rows(first, last))
+
+    def time_range(self, t0, t1):
+        '''Heads of the frames with t0 <= timestamp < t1 seconds'''
+        first, last = np.searchsorted(self.index['timestamp'], [t0, t1])
+        return self.rows(*self._index_rows(first, last))
+
+def record_video(source, path, buffer_rows=4096, **kwargs):
+    '''Streams estimate_video results of source into a store at path, returns the number of frames'''
+    from pose_stream import estimate_video
+    frames = 0
+    with ResultWriter(path, buffer_rows, meta={'source': str(source)}) as writer:
+        for result in estimate_video(source, **kwargs):
+            writer.append(result.index, result.timestamp, result.boxes, result.scores, result.angles, result.track_ids)
+            frames += 1
+    return frames
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='record head pose results of a video into a columnar result store')
+    parser.add_argument('--video', type=str, default='IMG_0176.mp4', help='path to video file. use camera if no file is given')
+    parser.add_argument('--store', type=str, default='results', help='output store directory')
+    parser.add_argument('--snapshot', type=str, default='WHENet.h5', help='whenet snapshot path')
+    parser.add_argument('--score', type=float, default=0.3, help='yolo confidence score threshold')
+    parser.add_argument('--iou', type=float, default=0.3, help='yolo iou threshold')
+    parser.add_argument('--detect_every', type=int, default=1, help='run yolo every k frames and track heads in between')
+    parser.add_argument('--batch_size', type=int, default=8, help='frames per forward pass when detect_every is 1')
+    parser.add_argument('--frame_step', type=int, default=1, help='only estimate every k-th frame')
+    parser.add_argument('--buffer_rows', type=int, default=4096, help='heads buffered in memory between writes')
+    parser.add_argument('--gpu', type=str, default='0', help='gpu')
+    args = parser.parse_args()
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    frames = record_video(0 if args.video == '' else args.video, args.store, args.buffer_rows,
+                          snapshot=args.snapshot, score=args.score, iou=args.iou, detect_every=args.detect_every,
+                          batch_size=args.batch_size, frame_step=args.frame_step)
+    print('{} frames recorded to {}'.format(frames, args.store))
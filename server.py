@@ -0,0 +1,284 @@
+'''
+Local head pose inference server with dynamic micro-batching.
+
+One process holds WHENet and YOLO, and concurrent HTTP requests are grouped into
+micro-batches: a batch is run as soon as it holds --max_batch requests or the
+oldest request has waited --max_wait_ms. All frames of a batch go through one
+YOLO detect_batch call and all of their heads through one WHENet forward pass.
+
+    python server.py --port 8000 [--unix_socket /tmp/whenet.sock]
+
+POST an encoded image (jpeg, png, ...) to /pose. Heads are detected with YOLO
+and expanded by the demo margin, unless boxes are given in the query string,
+which are then cropped as they are (same format as a bbox.txt line):
+
+    curl --data-binary @Sample/mov_001_007585.jpeg 'localhost:8000/pose'
+    curl --data-binary @Sample/mov_001_007585.jpeg 'localhost:8000/pose?boxes=240+0+304+83,10+20+60+80'
+
+The response is {"heads": [{"box": [x_min, y_min, x_max, y_max], "score": s or null,
+"yaw": y, "pitch": p, "roll": r}, ...]}. GET /stats returns the batching statistics.
+'''
+import os
+import json
+import argparse
+import threading
+from queue import Queue, Empty
+from socketserver import ThreadingMixIn, UnixStreamServer
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from timeit import default_timer as timer
+import numpy as np
+import cv2
+from keras import backend as K
+from whenet import WHENet
+from utils import expand_bboxes, RoiCropper
+
+def parse_boxes(value):
+    '''"x_min y_min x_max y_max,..." -> (N,4) int32'''
+    boxes = [[int(float(v)) for v in box.split()] for box in value.split(',') if box.strip()]
+    if any(len(box) != 4 for box in boxes):
+        raise ValueError('boxes must be x_min y_min x_max y_max, comma separated')
+    return np.array(boxes, dtype=np.int32).reshape(-1, 4)
+
+class BatchItem(object):
+    def __init__(self, payload):
+        self.payload = payload
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+class MicroBatcher(object):
+    '''Collects items submitted from many threads and hands them to process(list of payloads)
+    -> list of results on a single worker thread, in batches of at most max_batch items.
+    A batch is started when it is full or its first item has waited max_wait_ms. A result that
+    is an exception is raised in the thread that submitted that item only.'''
+    def __init__(self, process, max_batch=16, max_wait_ms=5., graph=None):
+        self.process = process
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.
+        self.graph = graph
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.batches = 0
+        self.items = 0
+        self.busy = 0.
+        self.worker = threading.Thread(target=self._run, name='micro_batcher')
+        self.worker.daemon = True
+        self.worker.start()
+
+    def submit(self, payload):
+        '''Blocks until the batch holding payload has been processed, returns its result'''
+        item = BatchItem(payload)
+        self.queue.put(item)
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.result
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = timer() + self.max_wait
+        while len(batch) < self.max_batch:
+            remaining = deadline - timer()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=remaining))
+            except Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            tic = timer()
+            try:
+                if self.graph is not None:
+                    with self.graph.as_default():
+                        results = self.process([item.payload for item in batch])
+                else:
+                    results = self.process([item.payload for item in batch])
+                for item, result in zip(batch, results):
+                    if isinstance(result, Exception):
+                        item.error = result
+                    else:
+                        item.result = result
+            except Exception as e:
+                for item in batch:
+                    item.error = e
+            with self.lock:
+                self.batches += 1
+                self.items += len(batch)
+                self.busy += timer() - tic
+            for item in batch:
+                item.done.set()
+
+    def stats(self):
+        with self.lock:
+            return {
+                'batches': self.batches,
+                'requests': self.items,
+                'mean_batch_size': self.items / float(self.batches) if self.batches else 0.,
+                'busy_ms_per_batch': 1000. * self.busy / self.batches if self.batches else 0.,
+                'queued': self.queue.qsize(),
+            }
+
+class HeadPoseService(object):
+    '''process function of the batcher: list of (BGR frame, boxes or None) -> list of head dicts,
+    or of the exception for a request that failed, so that it does not fail the rest of the batch'''
+    def __init__(self, whenet, yolo=None, max_faces=64):
+        self.whenet = whenet
+        self.yolo = yolo
+        self.cropper = RoiCropper(capacity=max_faces)
+
+    def __call__(self, requests):
+        results = [None] * len(requests)
+        boxes = [b for _, b in requests]
+        scores = [None] * len(requests)
+        to_detect = [i for i, b in enumerate(boxes) if b is None]
+        if to_detect and self.yolo is None:
+            for i in to_detect:
+                results[i] = ValueError('server runs without a detector, boxes must be given')
+                boxes[i] = np.zeros((0, 4), dtype=np.int32)
+        elif to_detect:
+            detections = self.yolo.detect_batch([requests[i][0] for i in to_detect])
+            for i, (bboxes, bscores, _) in zip(to_detect, detections):
+                boxes[i] = expand_bboxes(bboxes, requests[i][0].shape)
+                scores[i] = bscores
+
+        # crops of all requests in one array, a single WHENet forward pass for the whole batch
+        counts = [len(b) for b in boxes]
+        crops = np.zeros((sum(counts), self.cropper.size, self.cropper.size, 3), dtype=np.uint8)
+        offsets = np.cumsum([0] + counts)
+        for i, ((frame, _), b, start, end) in enumerate(zip(requests, boxes, offsets[:-1], offsets[1:])):
+            if results[i] is None:
+                try:
+                    crops[start:end] = self.cropper(frame, b)
+                except Exception as e:
+                    results[i] = e
+        angles = self.whenet.get_angles(crops)
+
+        for i, (b, s, start, end) in enumerate(zip(boxes, scores, offsets[:-1], offsets[1:])):
+            if results[i] is not None:
+                continue
+            results[i] = [{
+                'box': [int(v) for v in box],
+                'score': float(s[j]) if s is not None else None,
+                'yaw': float(yaw), 'pitch': float(pitch), 'roll': float(roll),
+            } for j, (box, (yaw, pitch, roll)) in enumerate(zip(b, angles[start:end]))]
+        return results
+
+class Handler(BaseHTTPRequestHandler):
+    def _send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if urlparse(self.path).path != '/stats':
+            return self._send_json(404, {'error': 'not found'})
+        self._send_json(200, self.server.batcher.stats())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/pose':
+            return self._send_json(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            length = -1
+        if length < 0:
+            return self._send_json(400, {'error': 'invalid Content-Length'})
+        data = self.rfile.read(length)
+        if not data:
+            return self._send_json(400, {'error': 'no image in the request body'})
+        # decoding happens on the request thread, only inference is serialized in the batcher
+        try:
+            frame = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+        except cv2.error:
+            frame = None
+        if frame is None:
+            return self._send_json(400, {'error': 'could not decode image'})
+        try:
+            query = parse_qs(url.query)
+            boxes = parse_boxes(query['boxes'][0]) if 'boxes' in query else None
+        except ValueError as e:
+            return self._send_json(400, {'error': str(e)})
+        # requests the batch can not serve are answered here, before they join a batch
+        if boxes is None and self.server.pose_only:
+            return self._send_json(400, {'error': 'server runs without a detector, boxes must be given'})
+        if boxes is not None:
+            boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, frame.shape[1])
+            boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, frame.shape[0])
+        try:
+            heads = self.server.batcher.submit((frame, boxes))
+        except ValueError as e:
+            return self._send_json(400, {'error': str(e)})
+        except Exception as e:
+            return self._send_json(500, {'error': '{}: {}'.format(type(e).__name__, e)})
+        self._send_json(200, {'heads': heads})
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = self.socket.accept()
+        # BaseHTTPRequestHandler logs client_address as (host, port)
+        return request, ('unix', 0)
+
+def make_server(args, batcher):
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = ThreadingUnixHTTPServer(args.unix_socket, Handler)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.batcher = batcher
+    server.quiet = args.quiet
+    server.pose_only = args.pose_only
+    return server
+
+def main(args):
+    whenet = WHENet(snapshot=args.snapshot, uint8_input=True, cache_dir=args.cache_dir)
+    yolo = None
+    if not args.pose_only:
+        from yolo_v3.yolo_postprocess import YOLO
+        yolo = YOLO(score=args.score, iou=args.iou, cache_dir=args.cache_dir)
+    batcher = MicroBatcher(HeadPoseService(whenet, yolo), max_batch=args.max_batch,
+                           max_wait_ms=args.max_wait_ms, graph=K.get_session().graph)
+    server = make_server(args, batcher)
+    print('serving on', args.unix_socket or '{}:{}'.format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='local whenet / yolo server with micro-batching')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='port to listen on')
+    parser.add_argument('--unix_socket', type=str, default=None, help='listen on this unix socket instead of tcp')
+    parser.add_argument('--snapshot', type=str, default='WHENet.h5', help='whenet snapshot path')
+    parser.add_argument('--pose_only', action='store_true', help='do not load yolo, every request must give boxes')
+    parser.add_argument('--score', type=float, default=0.3, help='yolo confidence score threshold')
+    parser.add_argument('--iou', type=float, default=0.3, help='yolo iou threshold')
+    parser.add_argument('--max_batch', type=int, default=16, help='max requests per micro-batch')
+    parser.add_argument('--max_wait_ms', type=float, default=5., help='max time the first request of a batch waits for more')
+    parser.add_argument('--cache_dir', type=str, default=None, help='frozen model cache directory')
+    parser.add_argument('--quiet', action='store_true', help='do not log every request')
+    parser.add_argument('--gpu', type=str, default='0', help='gpu')
+    args = parser.parse_args()
+    os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
+    os.environ["CUDA_VISIBLE_DEVICES"] = args.gpu
+    main(args)
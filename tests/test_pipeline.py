@@ -0,0 +1,62 @@
+import os
+import sys
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from pipeline import VideoPipeline
+
+def run_with_timeout(pipeline, timeout=10.):
+    '''run() on a thread, returns (finished, exception raised by run or None)'''
+    outcome = {}
+    def target():
+        try:
+            pipeline.run()
+        except Exception as e:
+            outcome['error'] = e
+    t = threading.Thread(target=target)
+    t.daemon = True
+    t.start()
+    t.join(timeout)
+    return not t.is_alive(), outcome.get('error')
+
+class VideoPipelineTest(unittest.TestCase):
+    def test_items_pass_through_in_order(self):
+        out = []
+        pipeline = VideoPipeline(range(50), [('double', lambda x: 2 * x), ('inc', lambda x: x + 1)], out.append,
+                                 queue_size=2)
+        finished, error = run_with_timeout(pipeline)
+        self.assertTrue(finished)
+        self.assertIsNone(error)
+        self.assertEqual(out, [2 * x + 1 for x in range(50)])
+
+    def test_stage_error_is_raised_by_run(self):
+        def fail(x):
+            if x == 5:
+                raise RuntimeError('stage failed')
+            return x
+        # the queues are small and the source is long, upstream threads block on full queues
+        pipeline = VideoPipeline(range(10000), [('fail', fail), ('pass', lambda x: x)], lambda x: None,
+                                 queue_size=1)
+        finished, error = run_with_timeout(pipeline)
+        self.assertTrue(finished)
+        self.assertIsInstance(error, RuntimeError)
+
+    def test_source_error_is_raised_by_run(self):
+        def source():
+            for i in range(5):
+                yield i
+            raise IOError('decode failed')
+        pipeline = VideoPipeline(source(), [('pass', lambda x: x)], lambda x: None)
+        finished, error = run_with_timeout(pipeline)
+        self.assertTrue(finished)
+        self.assertIsInstance(error, IOError)
+
+    def test_sink_stop(self):
+        pipeline = VideoPipeline(range(10000), [('pass', lambda x: x)], lambda x: x < 3, queue_size=1)
+        finished, error = run_with_timeout(pipeline)
+        self.assertTrue(finished)
+        self.assertIsNone(error)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,152 @@
+'''
+Multi-object head tracking used to skip the YOLO detector on most frames.
+
+Tracks are propagated with a constant velocity Kalman filter and associated to
+detections by IoU (SORT style). TrackingDetector runs the detector only every k
+frames, or earlier when the tracking confidence drops, and predicts boxes in
+between. Boxes use the detector layout: y_min, x_min, y_max, x_max.
+'''
+import numpy as np
+
+def iou_matrix(boxes_a, boxes_b):
+    '''IoU between (n,4) and (m,4) y_min, x_min, y_max, x_max boxes, shape (n,m)'''
+    boxes_a = np.asarray(boxes_a, dtype=np.float64).reshape(-1, 4)
+    boxes_b = np.asarray(boxes_b, dtype=np.float64).reshape(-1, 4)
+    tl = np.maximum(boxes_a[:, None, :2], boxes_b[None, :, :2])
+    br = np.minimum(boxes_a[:, None, 2:], boxes_b[None, :, 2:])
+    inter = np.prod(np.clip(br - tl, 0, None), axis=2)
+    area_a = np.prod(boxes_a[:, 2:] - boxes_a[:, :2], axis=1)
+    area_b = np.prod(boxes_b[:, 2:] - boxes_b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - inter
+    return inter / np.maximum(union, 1e-9)
+
+def associate(tracks, detections, iou_threshold):
+    '''Optimal IoU assignment, returns matched (track, detection) pairs and the unmatched indices'''
+    if len(tracks) == 0 or len(detections) == 0:
+        return [], list(range(len(tracks))), list(range(len(detections)))
+    from scipy.optimize import linear_sum_assignment
+    iou = iou_matrix(tracks, detections)
+    rows, cols = linear_sum_assignment(-iou)
+    matches = [(r, c) for r, c in zip(rows, cols) if iou[r, c] >= iou_threshold]
+    matched_t = set(r for r, _ in matches)
+    matched_d = set(c for _, c in matches)
+    unmatched_t = [t for t in range(len(tracks)) if t not in matched_t]
+    unmatched_d = [d for d in range(len(detections)) if d not in matched_d]
+    return matches, unmatched_t, unmatched_d
+
+class KalmanBoxTrack(object):
+    '''Constant velocity Kalman filter over the box center and size (cx, cy, w, h)'''
+    F = np.eye(8)
+    F[:4, 4:] = np.eye(4)
+    H = np.eye(4, 8)
+    Q = np.diag([1., 1., 1., 1., .01, .01, .0001, .0001])
+    R = np.diag([1., 1., 10., 10.])
+
+    def __init__(self, track_id, box, score):
+        self.id = track_id
+        self.x = np.zeros(8)
+        self.x[:4] = self._to_state(box)
+        self.P = np.diag([10., 10., 10., 10., 1000., 1000., 1000., 1000.])
+        self.score = score
+        self.hits = 1
+        self.age = 0
+        self.time_since_update = 0
+
+    @staticmethod
+    def _to_state(box):
+        y_min, x_min, y_max, x_max = box
+        return np.array([(x_min + x_max) / 2., (y_min + y_max) / 2., x_max - x_min, y_max - y_min])
+
+    @property
+    def box(self):
+        cx, cy, w, h = self.x[:4]
+        return np.array([cy - h / 2., cx - w / 2., cy + h / 2., cx + w / 2.])
+
+    def predict(self):
+        if self.x[2] + self.x[6] <= 0:
+            self.x[6] = 0.
+        if self.x[3] + self.x[7] <= 0:
+            self.x[7] = 0.
+        self.x = self.F @ self.x
+        self.P = self.F @ self.P @ self.F.T + self.Q
+        self.age += 1
+        self.time_since_update += 1
+        return self.box
+
+    def update(self, box, score):
+        y = self._to_state(box) - self.H @ self.x
+        S = self.H @ self.P @ self.H.T + self.R
+        K = self.P @ self.H.T @ np.linalg.inv(S)
+        self.x = self.x + K @ y
+        self.P = (np.eye(8) - K @ self.H) @ self.P
+        self.score = score
+        self.hits += 1
+        self.time_since_update = 0
+
+    def confidence(self, decay):
+        return self.score * decay ** self.time_since_update
+
+class MultiTracker(object):
+    '''IoU + Kalman multi-object tracker with stable track ids'''
+    def __init__(self, iou_threshold=0.3, max_age=10, decay=0.9):
+        self.iou_threshold = iou_threshold
+        self.max_age = max_age
+        self.decay = decay
+        self.tracks = []
+        self.next_id = 0
+
+    def predict(self):
+        for t in self.tracks:
+            t.predict()
+        self.tracks = [t for t in self.tracks if t.time_since_update <= self.max_age]
+
+    def update(self, boxes, scores):
+        '''Correct the predicted tracks with a new set of detections'''
+        boxes = np.asarray(boxes).reshape(-1, 4)
+        matches, _, unmatched_d = associate([t.box for t in self.tracks], boxes, self.iou_threshold)
+        for t, d in matches:
+            self.tracks[t].update(boxes[d], scores[d])
+        for d in unmatched_d:
+            self.tracks.append(KalmanBoxTrack(self.next_id, boxes[d], scores[d]))
+            self.next_id += 1
+
+    def results(self, max_staleness=None):
+        '''track ids (n,), boxes (n,4) and confidences (n,) of the tracks to report'''
+        tracks = [t for t in self.tracks if max_staleness is None or t.time_since_update <= max_staleness]
+        ids = np.array([t.id for t in tracks], dtype=np.int64)
+        boxes = np.array([t.box for t in tracks], dtype=np.float64).reshape(-1, 4)
+        scores = np.array([t.confidence(self.decay) for t in tracks], dtype=np.float64)
+        return ids, boxes, scores
+
+class TrackingDetector(object):
+    '''Runs detect_fn every detect_every frames, or sooner when the tracks become uncertain,
+    and propagates the tracked boxes on the frames in between.
+
+    detect_fn -- fn(frame) -> (boxes, scores, ...) such as YOLO.detect_frame
+    '''
+    def __init__(self, detect_fn, detect_every=5, min_confidence=0.2, iou_threshold=0.3, max_age=None):
+        self.detect_fn = detect_fn
+        self.detect_every = detect_every
+        self.min_confidence = min_confidence
+        self.tracker = MultiTracker(iou_threshold=iou_threshold,
+                                    max_age=max_age if max_age is not None else 2 * detect_every)
+        self.frame_count = 0
+        self.since_detection = 0
+        self.detections = 0
+
+    def __call__(self, frame):
+        '''Returns track ids, boxes and confidences for this frame'''
+        self.tracker.predict()
+        self.since_detection += 1
+        # report the tracks that were matched by the most recent detector run
+        ids, boxes, scores = self.tracker.results(max_staleness=self.since_detection)
+        run_detector = self.frame_count % self.detect_every == 0 or \
+            (len(scores) > 0 and scores.min() < self.min_confidence)
+        self.frame_count += 1
+        if run_detector:
+            det_boxes, det_scores = self.detect_fn(frame)[:2]
+            self.tracker.update(det_boxes, det_scores)
+            self.since_detection = 0
+            self.detections += 1
+            ids, boxes, scores = self.tracker.results(max_staleness=0)
+        return ids, boxes, scores
@@ -2,13 +2,10 @@ import numpy as np
 from math import cos, sin, pi
 import math
 import cv2
-from scipy.spatial import Delaunay
 
 def softmax(x):
-    x -= np.max(x,axis=1, keepdims=True)
-    a = np.exp(x)
-    b = np.sum(np.exp(x), axis=1, keepdims=True)
-    return a/b
+    e = np.exp(x - np.max(x, axis=1, keepdims=True))
+    return e / np.sum(e, axis=1, keepdims=True)
 
 def draw_axis(img, yaw, pitch, roll, tdx=None, tdy=None, size = 100):
     # Referenced from HopeNet https://github.com/natanielruiz/deep-head-pose
@@ -42,6 +39,48 @@ def draw_axis(img, yaw, pitch, roll, tdx=None, tdy=None, size = 100):
     cv2.line(img, (int(tdx), int(tdy)), (int(x3),int(y3)),(255,0,0),2)
     return img
 
+def expand_bboxes(bboxes, img_shape):
+    """ Enlarge detector boxes (N,4: y_min, x_min, y_max, x_max) to include background
+    margin, clipped to the image. Returns (N,4) boxes as x_min, y_min, x_max, y_max.
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 4)
+    y_min, x_min, y_max, x_max = bboxes.T
+    y_min = np.maximum(0, y_min - np.abs(y_min - y_max) / 10)
+    y_max = np.minimum(img_shape[0], y_max + np.abs(y_min - y_max) / 10)
+    x_min = np.maximum(0, x_min - np.abs(x_min - x_max) / 5)
+    x_max = np.minimum(img_shape[1], x_max + np.abs(x_min - x_max) / 5)
+    return np.stack([x_min, y_min, x_max, y_max], axis=1)
+
+class RoiCropper(object):
+    """ Crops and resizes all boxes of a frame into one reused (N,size,size,3) uint8 buffer.
+    The BGR->RGB swap is done once on the whole batch instead of once per crop.
+    """
+    def __init__(self, size=224, capacity=16):
+        self.size = size
+        self.batch = np.zeros((capacity, size, size, 3), dtype=np.uint8)
+
+    def __call__(self, img, boxes, bgr=True):
+        """ boxes: (N,4) x_min, y_min, x_max, y_max in pixels, clipped to the image.
+        Boxes with no area inside the image give black crops.
+        Returns a view on the first N crops, only valid until the next call.
+        """
+        boxes = np.asarray(boxes).reshape(-1, 4).astype(np.int32)
+        boxes[:, 0::2] = np.clip(boxes[:, 0::2], 0, img.shape[1])
+        boxes[:, 1::2] = np.clip(boxes[:, 1::2], 0, img.shape[0])
+        n = len(boxes)
+        if n > len(self.batch):
+            self.batch = np.zeros((max(n, 2 * len(self.batch)), self.size, self.size, 3), dtype=np.uint8)
+        for i, (x_min, y_min, x_max, y_max) in enumerate(boxes):
+            if x_max <= x_min or y_max <= y_min:
+                self.batch[i] = 0
+                continue
+            cv2.resize(img[y_min:y_max, x_min:x_max], (self.size, self.size), dst=self.batch[i])
+        crops = self.batch[:n]
+        if bgr and n > 0:
+            rows = crops.reshape(-1, self.size, 3)
+            cv2.cvtColor(rows, cv2.COLOR_BGR2RGB, dst=rows)
+        return crops
+
 def projectPoints(X, K, R, t, Kd):
     """ Projects points X (3xN) using camera intrinsics K (3x3),
     extrinsics (R,t) and distortion parameters Kd=[k1,k2,p1,p2,k3].
@@ -115,6 +154,52 @@ def align(model, data):
 
     return rot, trans, trans_error, s
 
+def align_batch(model, data, mask=None):
+    """align for B point sets at once, with stacked SVDs instead of loops.
+
+    Input:
+    model -- first trajectories (Bx3xn)
+    data -- second trajectories (Bx3xn)
+    mask -- points used per set (Bxn bool), all when None
+
+    Output:
+    rot -- rotation matrices (Bx3x3)
+    trans -- translation vectors (Bx3x1)
+    trans_error -- translational error per point (Bxn), 0 where masked out
+    s -- scales (B)
+
+    """
+    model = np.asarray(model)
+    data = np.asarray(data)
+    if mask is None:
+        mask = np.ones((model.shape[0], model.shape[2]), dtype=bool)
+    m = mask[:, None, :]
+    n = mask.sum(1)[:, None, None]
+    model = np.where(m, model, 0)
+    data = np.where(m, data, 0)
+    model_mean = model.sum(2, keepdims=True) / n
+    data_mean = data.sum(2, keepdims=True) / n
+    model_zerocentered = np.where(m, model - model_mean, 0)
+    data_zerocentered = np.where(m, data - data_mean, 0)
+
+    W = np.einsum('bik,bjk->bij', model_zerocentered, data_zerocentered)
+    U, d, Vh = np.linalg.svd(W.transpose(0, 2, 1))
+    S = np.ones((len(W), 3))
+    S[np.linalg.det(U) * np.linalg.det(Vh) < 0, 2] = -1
+    rot = (U * S[:, None, :]) @ Vh
+
+    rotmodel = rot @ model_zerocentered
+    dots = np.einsum('bik,bik->b', data_zerocentered, rotmodel)
+    norms = np.einsum('bik,bik->b', model_zerocentered, model_zerocentered)
+    s = dots / norms
+
+    trans = data_mean - s[:, None, None] * rot @ model_mean
+
+    alignment_error = s[:, None, None] * rot @ model + trans - data
+    trans_error = np.where(mask, np.sqrt(np.einsum('bik,bik->bk', alignment_error, alignment_error)), 0)
+
+    return rot, trans, trans_error, s
+
 def rotationMatrixToEulerAngles2(R):
     y1 = -math.asin(R[2,0])
     y2 = math.pi - y1
@@ -161,6 +246,8 @@ def reference_head(scale=0.01,pyr=(10.,0.0,0.0)):
         [0.746313, 0.348381, 6.263227], [1.930245, 0.424351, 5.914376],
         [2.005628, 1.409845, 6.165652], [0.973987, 1.916389, 7.654050],
         [0.981972, 4.554081, 6.301271]]).T
+    # scipy is only needed for dataset preparation, keep it out of the inference imports
+    from scipy.spatial import Delaunay
     R = rotate_zyx( np.deg2rad(pyr) )
     kps = transform( R, kps*scale )
     tris = Delaunay( kps[:2].T ).simplices.copy()
@@ -232,3 +319,52 @@ def inverse_rotate_zyx(M):
         z0 = np.arctan2(M[0, 1] / cy0, M[0, 0] / cy0)
         z1 = np.arctan2(M[0, 1] / cy1, M[0, 0] / cy1)
         return np.array((x0, y0, z0)), np.array((x1, y1, z1))
+
+AXIS_COLORS = ((0,0,255), (0,255,0), (255,0,0)) # x red, y green, z blue (BGR)
+
+def axis_endpoints(angles, centers, sizes):
+    """ draw_axis geometry for N heads at once. angles: (N,3) yaw, pitch, roll in degrees,
+    centers: (N,2) x, y, sizes: (N,). Returns (N,3,2) x, y end points of the x, y and z axis.
+    """
+    angles = np.radians(np.asarray(angles, dtype=np.float64).reshape(-1, 3))
+    yaw, pitch, roll = -angles[:, 0], angles[:, 1], angles[:, 2]
+    cy, sy, cp, sp, cr, sr = np.cos(yaw), np.sin(yaw), np.cos(pitch), np.sin(pitch), np.cos(roll), np.sin(roll)
+    x = np.stack([cy * cr, -cy * sr, sy], axis=1)
+    y = np.stack([cp * sr + cr * sp * sy, cp * cr - sp * sy * sr, -cy * sp], axis=1)
+    ends = np.stack([x, y], axis=2) * np.asarray(sizes, dtype=np.float64).reshape(-1, 1, 1)
+    return ends + np.asarray(centers, dtype=np.float64).reshape(-1, 1, 2)
+
+class OverlayRenderer(object):
+    """ Draws the boxes, pose axes and labels of all heads of a frame. Geometry is computed
+    for all heads together and boxes / axes are drawn with one cv2.polylines call per color.
+    With enabled=False (headless) calls return the frame untouched.
+    """
+    def __init__(self, display='simple', enabled=True):
+        self.display = display
+        self.enabled = enabled
+
+    def __call__(self, img, boxes, angles, track_ids=None):
+        """ boxes: (N,4) x_min, y_min, x_max, y_max, angles: (N,3) yaw, pitch, roll """
+        if not self.enabled or len(boxes) == 0:
+            return img
+        boxes = np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+        x_min, y_min, x_max, y_max = boxes.T
+        centers = np.stack([(x_min + x_max) / 2, (y_min + y_max) / 2], axis=1)
+        ends = axis_endpoints(angles, centers, np.abs(x_max - x_min) // 2)
+
+        corners = boxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2).astype(np.int32)
+        cv2.polylines(img, list(corners), True, (0,0,0), 2)
+        for axis, color in enumerate(AXIS_COLORS):
+            segments = np.stack([centers, ends[:, axis]], axis=1).astype(np.int32)
+            cv2.polylines(img, list(segments), False, color, 2)
+
+        left, top, bottom = x_min.astype(int), y_min.astype(int), y_max.astype(int)
+        if track_ids is not None:
+            for i, track_id in enumerate(track_ids):
+                cv2.putText(img, "id: {}".format(track_id), (left[i], bottom[i] + 12), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 255, 255), 1)
+        if self.display == 'full':
+            for i, (yaw, pitch, roll) in enumerate(np.round(angles)):
+                cv2.putText(img, "yaw: {}".format(yaw), (left[i], top[i]), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (100, 255, 0), 1)
+                cv2.putText(img, "pitch: {}".format(pitch), (left[i], top[i] - 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (100, 255, 0), 1)
+                cv2.putText(img, "roll: {}".format(roll), (left[i], top[i] - 30), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (100, 255, 0), 1)
+        return img
@@ -1,10 +1,150 @@
+import os
+import json
+import hashlib
 import efficientnet as efn
 import keras
+from keras import backend as K
 import numpy as np
+import tensorflow as tf
 from utils import softmax
 
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+# number of 3 degree bins and angle of the first bin for yaw, pitch and roll
+ANGLE_BINS = ((120, -180.), (66, -99.), (66, -99.))
+
+def normalize_input(x):
+    '''uint8 RGB -> float32 ImageNet-normalized, evaluated inside the keras graph'''
+    x = K.cast(x, 'float32') / 255.
+    return (x - K.constant(IMAGENET_MEAN)) / K.constant(IMAGENET_STD)
+
+def decode_angles(logits):
+    '''yaw, pitch, roll bin logits -> (N,3) expected angles in degrees, evaluated inside the keras graph'''
+    angles = [K.sum(K.softmax(x) * K.arange(bins, dtype='float32'), axis=1) * 3 + first
+              for x, (bins, first) in zip(logits, ANGLE_BINS)]
+    return K.stack(angles, axis=1)
+
+def angle_entropy(logits):
+    '''(N,3) entropy of the yaw, pitch, roll bin distributions divided by its maximum,
+    0 for a single bin, 1 for a uniform distribution'''
+    entropy = []
+    for x, (bins, _) in zip(logits, ANGLE_BINS):
+        p = K.softmax(x)
+        entropy.append(-K.sum(p * K.log(p + K.epsilon()), axis=1) / np.log(bins))
+    return K.stack(entropy, axis=1)
+
+def decode_angles_numpy(logits, uncertainty=False):
+    '''decode_angles (and angle_entropy) on the host, for the logit outputs of a .tflite model'''
+    probs = [softmax(x) for x in logits]
+    angles = np.stack([np.dot(p, np.arange(bins, dtype=np.float32)) * 3 + first
+                       for p, (bins, first) in zip(probs, ANGLE_BINS)], axis=1).astype(np.float32)
+    if not uncertainty:
+        return angles
+    entropy = np.stack([-np.sum(p * np.log(p + 1e-7), axis=1) / np.log(bins)
+                        for p, (bins, _) in zip(probs, ANGLE_BINS)], axis=1).astype(np.float32)
+    return [angles, entropy]
+
+def lite_module():
+    return tf.lite if hasattr(tf, 'lite') else tf.contrib.lite
+
+class LiteModel(object):
+    '''TFLite WHENet (e.g. int8 from quantize.py) with the predict interface of the keras model'''
+    def __init__(self, path):
+        self.interpreter = lite_module().Interpreter(model_path=path)
+        self.input_index = self.interpreter.get_input_details()[0]['index']
+        outputs = self.interpreter.get_output_details()
+        # outputs are matched by the names of the dense layers, pitch and roll have the same shape
+        self.output_indices = [[o['index'] for o in outputs if name in o['name']][0]
+                               for name in ('yaw_new', 'pitch_new', 'roll_new')]
+        self.batch_size = None
+
+    def predict(self, img, batch_size=8):
+        if img.dtype == np.uint8:
+            img = (img.astype(np.float32) / 255. - IMAGENET_MEAN) / IMAGENET_STD
+        img = img.astype(np.float32)
+        predictions = [[], [], []]
+        for start in range(0, len(img), batch_size):
+            batch = img[start:start+batch_size]
+            if len(batch) != self.batch_size:
+                self.interpreter.resize_tensor_input(self.input_index, batch.shape)
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(batch)
+            self.interpreter.set_tensor(self.input_index, batch)
+            self.interpreter.invoke()
+            for p, index in zip(predictions, self.output_indices):
+                p.append(self.interpreter.get_tensor(index))
+        return [np.concatenate(p) for p in predictions]
+
+def cache_path(cache_dir, snapshot, uint8_input, uncertainty=False):
+    '''Cache file of the frozen inference graph, keyed on the snapshot file and the input/output mode'''
+    key = [str(uint8_input), 'angles', str(uncertainty)]
+    if snapshot is not None:
+        stat = os.stat(snapshot)
+        key += [os.path.abspath(snapshot), str(stat.st_size), str(stat.st_mtime)]
+    digest = hashlib.sha1('|'.join(key).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, 'whenet_{}.pb'.format(digest))
+
+def freeze_model(model, path):
+    '''Write the keras model as a frozen GraphDef plus a .json with its input/output tensor names'''
+    sess = K.get_session()
+    output_names = [t.op.name for t in model.outputs]
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names)
+    meta = {'input': model.input.name, 'outputs': [t.name for t in model.outputs], 'learning_phase': None}
+    learning_phase = K.learning_phase()
+    if isinstance(learning_phase, tf.Tensor) and learning_phase.op.name in set(n.name for n in graph_def.node):
+        meta['learning_phase'] = learning_phase.name
+    if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(graph_def.SerializeToString())
+    with open(path + '.json', 'w') as f:
+        json.dump(meta, f)
+
+class FrozenModel(object):
+    '''Frozen WHENet GraphDef imported into the keras session, with the predict interface of the keras model.
+    Importing skips building EfficientNet layer by layer and loading the .h5, which dominates cold start.'''
+    def __init__(self, path, scope='whenet_frozen'):
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        with open(path + '.json') as f:
+            meta = json.load(f)
+        self.sess = K.get_session()
+        with self.sess.graph.as_default():
+            tf.import_graph_def(graph_def, name=scope)
+        get = lambda name: self.sess.graph.get_tensor_by_name('{}/{}'.format(scope, name))
+        self.input = get(meta['input'])
+        self.outputs = [get(name) for name in meta['outputs']]
+        self.feed = {get(meta['learning_phase']): False} if meta['learning_phase'] else {}
+
+    def predict(self, img, batch_size=8):
+        predictions = [[] for _ in self.outputs]
+        feed = dict(self.feed)
+        for start in range(0, len(img), batch_size):
+            feed[self.input] = img[start:start+batch_size]
+            for p, out in zip(predictions, self.sess.run(self.outputs, feed)):
+                p.append(out)
+        predictions = [np.concatenate(p) for p in predictions]
+        return predictions[0] if len(predictions) == 1 else predictions
+
 class WHENet:
-    def __init__(self, snapshot=None):
+    def __init__(self, snapshot=None, uint8_input=False, cache_dir=None, uncertainty=False):
+        '''snapshot  -- keras .h5 weights, or a .tflite model from quantize.py
+        uint8_input -- feed uint8 crops, normalization is done in the graph
+        cache_dir   -- keep a frozen inference graph here and load it instead of rebuilding the network
+        uncertainty -- also output the normalized entropy of every angle, high for unreliable crops'''
+        self.uint8_input = uint8_input
+        self.uncertainty = uncertainty
+        if snapshot is not None and snapshot.endswith('.tflite'):
+            self.model = LiteModel(snapshot)
+        elif cache_dir is not None and os.path.isfile(cache_path(cache_dir, snapshot, uint8_input, uncertainty)):
+            self.model = FrozenModel(cache_path(cache_dir, snapshot, uint8_input, uncertainty))
+        else:
+            self._build_keras(snapshot, uint8_input, uncertainty)
+            if cache_dir is not None:
+                freeze_model(self.model, cache_path(cache_dir, snapshot, uint8_input, uncertainty))
+
+    def _build_keras(self, snapshot, uint8_input, uncertainty):
         base_model = efn.EfficientNetB0(include_top=False, input_shape=(224, 224, 3))
         out = base_model.output
         out = keras.layers.GlobalAveragePooling2D()(out)
@@ -14,21 +154,47 @@ class WHENet:
         self.model = keras.models.Model(inputs=base_model.input, outputs=[fc_yaw, fc_pitch, fc_roll])
         if snapshot!=None:
             self.model.load_weights(snapshot)
-        self.idx_tensor = [idx for idx in range(66)]
-        self.idx_tensor = np.array(self.idx_tensor, dtype=np.float32)
-        self.idx_tensor_yaw = [idx for idx in range(120)]
-        self.idx_tensor_yaw = np.array(self.idx_tensor_yaw, dtype=np.float32)
-
-    def get_angle(self, img):
-        mean = [0.485, 0.456, 0.406]
-        std = [0.229, 0.224, 0.225]
-        img = img/255
-        img = (img - mean) / std
-        predictions = self.model.predict(img, batch_size=8)
-        yaw_predicted = softmax(predictions[0])
-        pitch_predicted = softmax(predictions[1])
-        roll_predicted = softmax(predictions[2])
-        yaw_predicted = np.sum(yaw_predicted*self.idx_tensor_yaw, axis=1)*3-180
-        pitch_predicted = np.sum(pitch_predicted * self.idx_tensor, axis=1) * 3 - 99
-        roll_predicted = np.sum(roll_predicted * self.idx_tensor, axis=1) * 3 - 99
-        return yaw_predicted, pitch_predicted, roll_predicted
\ No newline at end of file
+        # float input, logits output network, used for export and quantization
+        self.base_model = self.model
+        if uint8_input:
+            # feed raw uint8 NHWC crops, scaling and mean/std normalization happen in the graph
+            img_input = keras.layers.Input(shape=(224, 224, 3), dtype='uint8')
+            normalized = keras.layers.Lambda(normalize_input, name='normalize')(img_input)
+            self.model = keras.models.Model(inputs=img_input, outputs=self.model(normalized))
+        # decoding head, predict returns the (N,3) angles [and (N,3) entropy] instead of the bin logits
+        logits = self.model.outputs
+        outputs = [keras.layers.Lambda(decode_angles, output_shape=(3,), name='angles')(logits)]
+        if uncertainty:
+            outputs.append(keras.layers.Lambda(angle_entropy, output_shape=(3,), name='entropy')(logits))
+        self.model = keras.models.Model(inputs=self.model.input, outputs=outputs)
+        # build the predict function up front so the model can be used from worker threads
+        self.model._make_predict_function()
+
+    def _predict(self, img, batch_size):
+        if self.uint8_input:
+            img = np.asarray(img, dtype=np.uint8)
+        else:
+            img = img/255
+            img = (img - IMAGENET_MEAN) / IMAGENET_STD
+        predictions = self.model.predict(img, batch_size=batch_size)
+        if isinstance(self.model, LiteModel):
+            # the tflite model ends at the bin logits
+            return decode_angles_numpy(predictions, self.uncertainty)
+        return predictions
+
+    def get_angle(self, img, batch_size=8):
+        predictions = self._predict(img, batch_size)
+        angles = predictions[0] if self.uncertainty else predictions
+        return angles[:, 0], angles[:, 1], angles[:, 2]
+
+    def get_angles(self, crops, max_batch=64):
+        '''Predict euler angles for N 224x224 RGB head crops in as few forward passes as possible.
+        Returns an (N, 3) float32 array of [yaw, pitch, roll] in degrees, with uncertainty=True
+        also the (N, 3) normalized entropy of each angle.'''
+        if len(crops) == 0:
+            empty = np.zeros((0, 3), dtype=np.float32)
+            return (empty, empty.copy()) if self.uncertainty else empty
+        predictions = self._predict(np.asarray(crops), batch_size=min(len(crops), max_batch))
+        if self.uncertainty:
+            return predictions[0].astype(np.float32), predictions[1].astype(np.float32)
+        return predictions.astype(np.float32)
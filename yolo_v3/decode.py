@@ -0,0 +1,112 @@
+"""
+NumPy decoding of the raw yolo_body outputs, an alternative to yolo_eval.
+
+Cells are thresholded on the objectness logit first and only the surviving
+anchors are decoded into boxes, so for the single class head detector almost
+no box arithmetic is done. Produces the same boxes, scores and classes as
+yolo_eval without building any TF post-processing ops.
+"""
+
+import numpy as np
+
+def sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+def nms(boxes, scores, max_boxes, iou_threshold):
+    '''Greedy NMS like tf.image.non_max_suppression, returns kept indices by descending score'''
+    order = np.argsort(-scores, kind='stable')
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    keep = []
+    while len(order) > 0 and len(keep) < max_boxes:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+        tl = np.maximum(boxes[i, :2], boxes[rest, :2])
+        br = np.minimum(boxes[i, 2:], boxes[rest, 2:])
+        inter = np.prod(np.clip(br - tl, 0, None), axis=1)
+        iou = inter / np.maximum(areas[i] + areas[rest] - inter, 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+class YoloDecoder(object):
+    def __init__(self, anchors, num_classes, score_threshold=.6, iou_threshold=.5, max_boxes=20):
+        self.anchors = np.asarray(anchors, dtype=np.float32)
+        self.num_classes = num_classes
+        self.score_threshold = score_threshold
+        self.iou_threshold = iou_threshold
+        self.max_boxes = max_boxes
+        # score = sigmoid(obj) * sigmoid(cls) <= sigmoid(obj), so cells whose objectness
+        # logit is below logit(score_threshold) can never pass and are skipped undecoded
+        if 0. < score_threshold < 1.:
+            self.obj_logit_threshold = np.log(score_threshold / (1. - score_threshold))
+        else: # no finite logit, leave it all to the score threshold
+            self.obj_logit_threshold = -np.inf
+        self._anchor_cache = {}
+        self._correction_cache = {}
+
+    def _layer_anchors(self, num_layers, input_shape):
+        '''Per layer anchors normalized by the network input size, cached per size'''
+        key = (num_layers, input_shape)
+        if key not in self._anchor_cache:
+            anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]] # default setting
+            input_wh = np.array(input_shape[::-1], dtype=np.float32)
+            self._anchor_cache[key] = [self.anchors[mask] / input_wh for mask in anchor_mask]
+        return self._anchor_cache[key]
+
+    def _correction(self, input_shape, image_shape):
+        '''Letterbox offset and scale, see yolo_correct_boxes'''
+        key = (input_shape, image_shape)
+        if key not in self._correction_cache:
+            input_shape_ = np.array(input_shape, dtype=np.float32)
+            image_shape_ = np.array(image_shape, dtype=np.float32)
+            new_shape = np.round(image_shape_ * np.min(input_shape_/image_shape_))
+            offset = (input_shape_-new_shape)/2./input_shape_
+            scale = input_shape_/new_shape
+            self._correction_cache[key] = (offset, scale, np.concatenate([image_shape_, image_shape_]))
+        return self._correction_cache[key]
+
+    def __call__(self, yolo_outputs, image_shape):
+        '''Decode the raw outputs of one image.
+
+        yolo_outputs -- list of (grid_h, grid_w, num_anchors*(num_classes+5)) arrays,
+                        a leading batch dimension of 1 is dropped
+        image_shape  -- original (height, width)
+        '''
+        yolo_outputs = [o[0] if o.ndim == 4 else o for o in yolo_outputs]
+        num_layers = len(yolo_outputs)
+        input_shape = (yolo_outputs[0].shape[0] * 32, yolo_outputs[0].shape[1] * 32)
+        layer_anchors = self._layer_anchors(num_layers, input_shape)
+        offset, scale, box_scale = self._correction(input_shape, tuple(int(s) for s in image_shape[:2]))
+
+        boxes = []
+        box_scores = []
+        for feats, anchors in zip(yolo_outputs, layer_anchors):
+            grid_h, grid_w = feats.shape[:2]
+            feats = feats.reshape(grid_h, grid_w, len(anchors), self.num_classes + 5)
+            gy, gx, a = np.nonzero(feats[..., 4] >= self.obj_logit_threshold)
+            if len(a) == 0:
+                continue
+            cells = feats[gy, gx, a]
+            box_xy = (sigmoid(cells[:, 0:2]) + np.stack([gx, gy], axis=1)) / np.array([grid_w, grid_h], dtype=np.float32)
+            box_wh = np.exp(cells[:, 2:4]) * anchors[a]
+            box_yx = (box_xy[:, ::-1] - offset) * scale
+            box_hw = box_wh[:, ::-1] * scale
+            boxes.append(np.concatenate([box_yx - box_hw / 2., box_yx + box_hw / 2.], axis=1) * box_scale)
+            box_scores.append(sigmoid(cells[:, 4:5]) * sigmoid(cells[:, 5:]))
+
+        out_boxes, out_scores, out_classes = [], [], []
+        if boxes:
+            boxes = np.concatenate(boxes, axis=0)
+            box_scores = np.concatenate(box_scores, axis=0)
+            for c in range(self.num_classes):
+                mask = box_scores[:, c] >= self.score_threshold
+                class_boxes = boxes[mask]
+                class_scores = box_scores[mask, c]
+                keep = nms(class_boxes, class_scores, self.max_boxes, self.iou_threshold)
+                out_boxes.append(class_boxes[keep])
+                out_scores.append(class_scores[keep])
+                out_classes.append(np.full(len(keep), c, dtype=np.int32))
+        if not out_boxes:
+            return np.zeros((0, 4), dtype=np.float32), np.zeros((0,), dtype=np.float32), np.zeros((0,), dtype=np.int32)
+        return (np.concatenate(out_boxes).astype(np.float32), np.concatenate(out_scores).astype(np.float32),
+                np.concatenate(out_classes))
@@ -0,0 +1,143 @@
+"""
+Inference export of the YOLO head detector.
+
+Every DarknetConv2D_BN_Leaky block is rebuilt as a single biased Conv2D with the
+BatchNormalization parameters folded into its kernel and bias, and the l2
+regularizers (training only) are dropped. The folded model is saved as .h5,
+which YOLO loads like the original, and as a frozen, constant-folded GraphDef
+(.pb) that YOLO can load instead of rebuilding the Keras model:
+
+    python -m yolo_v3.export --model_path yolo_v3/data/head_detect.h5 --output yolo_v3/data/head_detect_inference
+"""
+
+import os
+import hashlib
+import argparse
+
+import numpy as np
+import tensorflow as tf
+from keras import backend as K
+from keras.layers import Input, Conv2D, BatchNormalization
+from keras.models import Model
+
+INPUT_NAME = 'yolo_input'
+OUTPUT_NAME = 'yolo_output_{}'
+
+def _nodes(layer, direction):
+    # keras made the node lists private in 2.1.x
+    return getattr(layer, '_{}_nodes'.format(direction), None) or getattr(layer, '{}_nodes'.format(direction))
+
+def fold_batchnorm(conv, bn):
+    """Kernel and bias of conv followed by bn (inference statistics) as one conv."""
+    weights = conv.get_weights()
+    kernel = weights[0]
+    bias = weights[1] if conv.use_bias else np.zeros(kernel.shape[-1], dtype=kernel.dtype)
+    bn_weights = bn.get_weights()
+    gamma = bn_weights.pop(0) if bn.scale else np.ones_like(bias)
+    beta = bn_weights.pop(0) if bn.center else np.zeros_like(bias)
+    mean, var = bn_weights
+    scale = gamma / np.sqrt(var + bn.epsilon)
+    return kernel * scale, (bias - mean) * scale + beta
+
+def _strip_training_config(config):
+    for key in ('kernel_regularizer', 'bias_regularizer', 'activity_regularizer'):
+        if key in config:
+            config[key] = None
+    return config
+
+def inference_model(model):
+    """Rebuild model with every Conv2D -> BatchNormalization pair folded into one Conv2D."""
+    tensors = {}
+    folded = set()
+    for layer in model.layers:
+        node = _nodes(layer, 'inbound')[0]
+        if not node.inbound_layers:
+            tensors[layer.output.name] = Input(batch_shape=layer.batch_input_shape, dtype=layer.dtype, name=INPUT_NAME)
+            continue
+        if layer.name in folded:
+            continue
+        inputs = [tensors[t.name] for t in node.input_tensors]
+        inputs = inputs[0] if len(inputs) == 1 else inputs
+
+        consumers = [n.outbound_layer for n in _nodes(layer, 'outbound')]
+        if isinstance(layer, Conv2D) and len(consumers) == 1 and isinstance(consumers[0], BatchNormalization):
+            bn = consumers[0]
+            config = _strip_training_config(layer.get_config())
+            config['use_bias'] = True
+            new_layer = Conv2D.from_config(config)
+            output = new_layer(inputs)
+            new_layer.set_weights(fold_batchnorm(layer, bn))
+            tensors[layer.output.name] = output
+            tensors[bn.output.name] = output
+            folded.add(bn.name)
+            continue
+
+        new_layer = layer.__class__.from_config(_strip_training_config(layer.get_config()))
+        tensors[layer.output.name] = new_layer(inputs)
+        new_layer.set_weights(layer.get_weights())
+    return Model(tensors[model.input.name], [tensors[t.name] for t in model.outputs])
+
+def freeze(model, path, sess=None):
+    """Write model as a frozen, constant-folded GraphDef with fixed input/output names."""
+    sess = sess or K.get_session()
+    output_names = []
+    for i, output in enumerate(model.outputs):
+        output_names.append(tf.identity(output, name=OUTPUT_NAME.format(i)).op.name)
+    graph_def = tf.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_names)
+    try:
+        from tensorflow.tools.graph_transforms import TransformGraph
+        graph_def = TransformGraph(graph_def, [model.input.op.name], output_names,
+                                   ['strip_unused_nodes', 'fold_constants(ignore_errors=true)', 'sort_by_execution_order'])
+    except ImportError:
+        pass
+    # the identity ops get a suffix when the graph already holds a frozen model, they are terminal so renaming is safe
+    for node in graph_def.node:
+        if node.name in output_names:
+            node.name = OUTPUT_NAME.format(output_names.index(node.name))
+    tf.train.write_graph(graph_def, os.path.dirname(path) or '.', os.path.basename(path), as_text=False)
+
+def cache_path(cache_dir, model_path):
+    """Cache file of the folded, frozen graph of model_path, keyed on the file's path, size and mtime."""
+    stat = os.stat(model_path)
+    key = '|'.join([os.path.abspath(model_path), str(stat.st_size), str(stat.st_mtime)])
+    return os.path.join(cache_dir, 'yolo_{}.pb'.format(hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]))
+
+class FrozenYolo(object):
+    """Frozen YOLO GraphDef imported into the current graph, exposing input/output like a keras Model."""
+    def __init__(self, path, num_outputs, scope='frozen_yolo'):
+        graph_def = tf.GraphDef()
+        with open(path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name=scope)
+        graph = tf.get_default_graph()
+        # the input keeps its keras name, which gets a suffix when the name was already taken
+        input_name = [n.name for n in graph_def.node if n.op == 'Placeholder' and n.name.startswith(INPUT_NAME)][0]
+        self.input = graph.get_tensor_by_name('{}/{}:0'.format(scope, input_name))
+        self.output = [graph.get_tensor_by_name('{}/{}:0'.format(scope, OUTPUT_NAME.format(i)))
+                       for i in range(num_outputs)]
+
+def export(model_path, output, anchors_path=None, classes_path=None):
+    from .yolo_postprocess import YOLO
+    K.set_learning_phase(0)
+    kwargs = {'model_path': model_path}
+    if anchors_path:
+        kwargs['anchors_path'] = anchors_path
+    if classes_path:
+        kwargs['classes_path'] = classes_path
+    yolo = YOLO(**kwargs)
+    model = inference_model(yolo.yolo_model)
+    model.save(output + '.h5', include_optimizer=False)
+    freeze(model, output + '.pb', yolo.sess)
+    print('{} -> {}.h5, {}.pb ({} BatchNormalization layers folded)'.format(
+        model_path, output, output, len(yolo.yolo_model.layers) - len(model.layers)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='fold batchnorm into convolutions and freeze the yolo head detector')
+    parser.add_argument('--model_path', type=str, default=os.path.join(os.path.dirname(__file__), 'data', 'head_detect.h5'))
+    parser.add_argument('--anchors_path', type=str, default=None)
+    parser.add_argument('--classes_path', type=str, default=None)
+    parser.add_argument('--output', type=str, default=os.path.join(os.path.dirname(__file__), 'data', 'head_detect_inference'),
+                        help='output path without extension, .h5 and .pb are written')
+    args = parser.parse_args()
+    export(args.model_path, args.output, args.anchors_path, args.classes_path)
@@ -156,7 +156,7 @@ def yolo_correct_boxes(box_xy, box_wh, input_shape, image_shape):
     box_hw = box_wh[..., ::-1]
     input_shape = K.cast(input_shape, K.dtype(box_yx))
     image_shape = K.cast(image_shape, K.dtype(box_yx))
-    new_shape = K.round(image_shape * K.min(input_shape/image_shape))
+    new_shape = K.round(image_shape * K.min(input_shape/image_shape, axis=-1, keepdims=True))
     offset = (input_shape-new_shape)/2./input_shape
     scale = input_shape/new_shape
     box_yx = (box_yx - offset) * scale
@@ -208,6 +208,11 @@ def yolo_eval(yolo_outputs,
     boxes = K.concatenate(boxes, axis=0)
     box_scores = K.concatenate(box_scores, axis=0)
 
+    return nms_per_class(boxes, box_scores, num_classes, max_boxes, score_threshold, iou_threshold)
+
+
+def nms_per_class(boxes, box_scores, num_classes, max_boxes, score_threshold, iou_threshold):
+    """Score thresholding and per class NMS of the (n, 4) boxes of one image."""
     mask = box_scores >= score_threshold
     max_boxes_tensor = K.constant(max_boxes, dtype='int32')
     boxes_ = []
@@ -232,6 +237,52 @@ def yolo_eval(yolo_outputs,
     return boxes_, scores_, classes_
 
 
+def yolo_eval_batch(yolo_outputs,
+              anchors,
+              num_classes,
+              image_shapes,
+              max_boxes=20,
+              score_threshold=.6,
+              iou_threshold=.5):
+    """Evaluate YOLO model on a batch of letterboxed images, with NMS per image.
+
+    image_shapes holds the original (height, width) of every image, shape=(batch, 2).
+    Returns boxes (batch, m, 4), scores (batch, m) and classes (batch, m) zero padded
+    to m = max_boxes*num_classes, and the number of valid detections per image.
+    """
+    num_layers = len(yolo_outputs)
+    anchor_mask = [[6,7,8], [3,4,5], [0,1,2]] if num_layers==3 else [[3,4,5], [1,2,3]] # default setting
+    input_shape = K.shape(yolo_outputs[0])[1:3] * 32
+    batch_size = K.shape(yolo_outputs[0])[0]
+    # broadcast each image shape against its (height, width, anchors, 2) grid
+    image_shapes_grid = K.reshape(image_shapes, [-1, 1, 1, 1, 2])
+    boxes = []
+    box_scores = []
+    for l in range(num_layers):
+        box_xy, box_wh, box_confidence, box_class_probs = yolo_head(yolo_outputs[l],
+            anchors[anchor_mask[l]], num_classes, input_shape)
+        _boxes = yolo_correct_boxes(box_xy, box_wh, input_shape, image_shapes_grid)
+        boxes.append(K.reshape(_boxes, [batch_size, -1, 4]))
+        box_scores.append(K.reshape(box_confidence * box_class_probs, [batch_size, -1, num_classes]))
+    boxes = K.concatenate(boxes, axis=1)
+    box_scores = K.concatenate(box_scores, axis=1)
+
+    max_detections = max_boxes * num_classes
+    def image_nms(args):
+        boxes_, scores_, classes_ = nms_per_class(args[0], args[1], num_classes,
+            max_boxes, score_threshold, iou_threshold)
+        count = K.shape(scores_)[0]
+        pad = max_detections - count
+        boxes_ = tf.pad(boxes_, [[0, pad], [0, 0]])
+        scores_ = tf.pad(scores_, [[0, pad]])
+        classes_ = tf.pad(classes_, [[0, pad]])
+        return boxes_, scores_, classes_, count
+
+    boxes_, scores_, classes_, counts = tf.map_fn(image_nms, (boxes, box_scores),
+        dtype=(tf.float32, tf.float32, tf.int32, tf.int32))
+    return boxes_, scores_, classes_, counts
+
+
 def preprocess_true_boxes(true_boxes, input_shape, anchors, num_classes):
     '''Preprocess true boxes to training input format
 
@@ -7,7 +7,7 @@ from functools import reduce
 
 from PIL import Image
 import numpy as np
-from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
+import cv2
 
 def compose(*funcs):
     """Compose arbitrarily many functions, evaluated left to right.
@@ -33,11 +33,52 @@ def letterbox_image(image, size):
     new_image.paste(image, ((w-nw)//2, (h-nh)//2))
     return new_image
 
+class FrameLetterbox(object):
+    '''OpenCV letterboxing of BGR frames into a persistent (1, h, w, 3) float32 RGB batch.
+
+    Same geometry as letterbox_image, but the padded canvas and the network input
+    are allocated once per input resolution and reused for every frame.
+    '''
+    def __init__(self, size):
+        w, h = size
+        self.size = size
+        self.canvas = np.full((h, w, 3), 128, dtype=np.uint8)
+        self.image_data = np.zeros((1, h, w, 3), dtype=np.float32)
+        self.frame_shape = None
+
+    def _set_frame_shape(self, frame_shape):
+        ih, iw = frame_shape[:2]
+        w, h = self.size
+        scale = min(w/iw, h/ih)
+        nw = int(iw*scale)
+        nh = int(ih*scale)
+        dx, dy = (w-nw)//2, (h-nh)//2
+        self.canvas[:] = 128
+        self.region = self.canvas[dy:dy+nh, dx:dx+nw]
+        self.interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_CUBIC
+        self.frame_shape = frame_shape
+
+    def __call__(self, frame, out=None):
+        '''Letterbox frame into out, a (h, w, 3) float32 array, defaults to self.image_data[0]'''
+        if frame.shape != self.frame_shape:
+            self._set_frame_shape(frame.shape)
+        nh, nw = self.region.shape[:2]
+        cv2.resize(frame, (nw, nh), dst=self.region, interpolation=self.interpolation)
+        # the gray padding is channel symmetric so the whole canvas can be swapped in place
+        cv2.cvtColor(self.canvas, cv2.COLOR_BGR2RGB, dst=self.canvas)
+        if out is None:
+            np.divide(self.canvas, 255., out=self.image_data[0])
+            return self.image_data
+        np.divide(self.canvas, 255., out=out)
+        return out
+
 def rand(a=0, b=1):
     return np.random.rand()*(b-a) + a
 
 def get_random_data(annotation_line, input_shape, random=True, max_boxes=20, jitter=.3, hue=.1, sat=1.5, val=1.5, proc_img=True):
     '''random preprocessing for real-time data augmentation'''
+    # matplotlib is only needed for training augmentation, keep it out of the inference imports
+    from matplotlib.colors import rgb_to_hsv, hsv_to_rgb
     line = annotation_line.split()
     image = Image.open(line[0])
     iw, ih = image.size
@@ -8,13 +8,16 @@ import colorsys
 from timeit import default_timer as timer
 
 import numpy as np
+import h5py
 from keras import backend as K
 from keras.models import load_model
 from keras.layers import Input
 from PIL import Image, ImageFont, ImageDraw
 import yolo_v3
-from .model import yolo_eval, yolo_body, tiny_yolo_body
-from .utils import letterbox_image
+from .model import yolo_eval, yolo_eval_batch, yolo_body, tiny_yolo_body
+from .utils import letterbox_image, FrameLetterbox
+from .decode import YoloDecoder
+from .export import FrozenYolo, inference_model, freeze, cache_path
 import os
 from keras.utils import multi_gpu_model
 import cv2
@@ -32,6 +35,8 @@ class YOLO(object):
         "iou" : 0.45,
         "model_image_size" : (416, 416),
         "gpu_num" : 1,
+        "decode" : "graph", # 'graph' (yolo_eval in TF) or 'numpy' (YoloDecoder on the raw outputs)
+        "cache_dir" : None, # keep a folded, frozen graph of the model here for fast start up
     }
 
     @classmethod
@@ -48,6 +53,10 @@ class YOLO(object):
         self.anchors = self._get_anchors()
         self.sess = K.get_session()
         self.boxes, self.scores, self.classes = self.generate()
+        self.letterbox = None
+        self.batch_outputs = None
+        self.batch_letterboxes = {}
+        self.batch_data = None
 
     def _get_class(self):
         classes_path = os.path.expanduser(self.classes_path)
@@ -65,22 +74,23 @@ class YOLO(object):
 
     def generate(self):
         model_path = os.path.expanduser(self.model_path)
-        assert model_path.endswith('.h5'), 'Keras model or weights must be a .h5 file.'
+        assert model_path.endswith('.h5') or model_path.endswith('.pb'), \
+            'Keras model or weights must be a .h5 file, or a frozen graph from yolo_v3.export a .pb file.'
 
         # Load model, or construct model and load weights.
         num_anchors = len(self.anchors)
         num_classes = len(self.class_names)
         is_tiny_version = num_anchors==6 # default setting
-        try:
-            self.yolo_model = load_model(model_path, compile=False)
-        except:
-            self.yolo_model = tiny_yolo_body(Input(shape=(None,None,3)), num_anchors//2, num_classes) \
-                if is_tiny_version else yolo_body(Input(shape=(None,None,3)), num_anchors//3, num_classes)
-            self.yolo_model.load_weights(self.model_path) # make sure model, anchors and classes match
+        cached = cache_path(self.cache_dir, model_path) if self.cache_dir and model_path.endswith('.h5') else None
+        if model_path.endswith('.pb'):
+            self.yolo_model = FrozenYolo(model_path, 2 if is_tiny_version else 3)
+        elif cached is not None and os.path.isfile(cached):
+            self.yolo_model = FrozenYolo(cached, 2 if is_tiny_version else 3)
         else:
-            assert self.yolo_model.layers[-1].output_shape[-1] == \
-                num_anchors/len(self.yolo_model.output) * (num_classes + 5), \
-                'Mismatch between model and given anchor and class sizes'
+            self.yolo_model = self._load_keras_model(model_path, num_anchors, num_classes, is_tiny_version)
+            if cached is not None:
+                self.yolo_model = inference_model(self.yolo_model)
+                freeze(self.yolo_model, cached, self.sess)
 
         print('{} model, anchors, and classes loaded.'.format(model_path))
 
@@ -97,13 +107,33 @@ class YOLO(object):
 
         # Generate output tensor targets for filtered bounding boxes.
         self.input_image_shape = K.placeholder(shape=(2, ))
-        if self.gpu_num>=2:
+        if self.gpu_num>=2 and not isinstance(self.yolo_model, FrozenYolo):
             self.yolo_model = multi_gpu_model(self.yolo_model, gpus=self.gpu_num)
+        if self.decode == 'numpy':
+            # decode on the host, no TF post-processing subgraph is built
+            self.decoder = YoloDecoder(self.anchors, len(self.class_names),
+                    score_threshold=self.score, iou_threshold=self.iou)
+            return None, None, None
         boxes, scores, classes = yolo_eval(self.yolo_model.output, self.anchors,
                 len(self.class_names), self.input_image_shape,
                 score_threshold=self.score, iou_threshold=self.iou)
         return boxes, scores, classes
 
+    def _load_keras_model(self, model_path, num_anchors, num_classes, is_tiny_version):
+        # a full model file carries its architecture, a weights only file does not
+        with h5py.File(model_path, 'r') as f:
+            full_model = 'model_config' in f.attrs
+        if not full_model:
+            yolo_model = tiny_yolo_body(Input(shape=(None,None,3)), num_anchors//2, num_classes) \
+                if is_tiny_version else yolo_body(Input(shape=(None,None,3)), num_anchors//3, num_classes)
+            yolo_model.load_weights(model_path) # make sure model, anchors and classes match
+        else:
+            yolo_model = load_model(model_path, compile=False)
+            assert yolo_model.layers[-1].output_shape[-1] == \
+                num_anchors/len(yolo_model.output) * (num_classes + 5), \
+                'Mismatch between model and given anchor and class sizes'
+        return yolo_model
+
     def detect_image(self, image):
         start = timer()
 
@@ -122,13 +152,7 @@ class YOLO(object):
         image_data /= 255.
         image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
 
-        out_boxes, out_scores, out_classes = self.sess.run(
-            [self.boxes, self.scores, self.classes],
-            feed_dict={
-                self.yolo_model.input: image_data,
-                self.input_image_shape: [image.size[1], image.size[0]],
-                K.learning_phase(): 0
-            })
+        out_boxes, out_scores, out_classes = self._run(image_data, [image.size[1], image.size[0]])
 
         print('Found {} boxes for {}'.format(len(out_boxes), 'img'))
 
@@ -195,15 +219,88 @@ class YOLO(object):
         image_data /= 255.
         image_data = np.expand_dims(image_data, 0)  # Add batch dimension.
 
+        return self._run(image_data, (image.size[1], image.size[0]))
+
+    def _run(self, image_data, image_shape):
+        """Run the network on one letterboxed image, image_shape is the original (height, width)."""
+        if self.decode == 'numpy':
+            outputs = self.sess.run(self.yolo_model.output,
+                feed_dict={self.yolo_model.input: image_data, K.learning_phase(): 0})
+            return self.decoder(outputs, image_shape)
         out_boxes, out_scores, out_classes = self.sess.run(
             [self.boxes, self.scores, self.classes],
             feed_dict={
                 self.yolo_model.input: image_data,
-                self.input_image_shape: [image.size[1], image.size[0]],
+                self.input_image_shape: image_shape,
                 K.learning_phase(): 0
             })
         return out_boxes, out_scores, out_classes
 
+    def _letterbox_frame(self, frame):
+        if self.model_image_size != (None, None):
+            assert self.model_image_size[0]%32 == 0, 'Multiples of 32 required'
+            assert self.model_image_size[1]%32 == 0, 'Multiples of 32 required'
+            size = tuple(reversed(self.model_image_size))
+        else:
+            size = (frame.shape[1] - (frame.shape[1] % 32),
+                    frame.shape[0] - (frame.shape[0] % 32))
+        if self.letterbox is None or self.letterbox.size != size:
+            self.letterbox = FrameLetterbox(size)
+        return self.letterbox(frame)
+
+    def detect_frame(self, frame):
+        """Same as detect, but takes a BGR ndarray (e.g. from cv2.VideoCapture) directly.
+
+        The frame is letterboxed with OpenCV into a persistent input buffer, so
+        no PIL conversion, per-frame input allocation or logging takes place.
+        """
+        image_data = self._letterbox_frame(frame)
+        return self._run(image_data, frame.shape[:2])
+
+    def _generate_batch(self):
+        """Batched detection graph, built on first use of detect_batch."""
+        self.input_image_shapes = K.placeholder(shape=(None, 2))
+        self.batch_outputs = yolo_eval_batch(self.yolo_model.output, self.anchors,
+                len(self.class_names), self.input_image_shapes,
+                score_threshold=self.score, iou_threshold=self.iou)
+
+    def detect_batch(self, frames, batch_size=8):
+        """Detect heads in a list of BGR frames, running up to batch_size frames per sess.run.
+
+        Frames may have different resolutions, NMS is done per frame. Returns one
+        (boxes, scores, classes) tuple per frame, like detect_frame.
+        """
+        assert self.model_image_size != (None, None), 'detect_batch needs a fixed model_image_size'
+        if self.batch_outputs is None and self.decode != 'numpy':
+            self._generate_batch()
+        h, w = self.model_image_size
+        if self.batch_data is None or len(self.batch_data) < min(len(frames), batch_size):
+            self.batch_data = np.zeros((min(len(frames), batch_size), h, w, 3), dtype=np.float32)
+
+        results = []
+        for start in range(0, len(frames), batch_size):
+            chunk = frames[start:start+batch_size]
+            for i, frame in enumerate(chunk):
+                if frame.shape not in self.batch_letterboxes:
+                    self.batch_letterboxes[frame.shape] = FrameLetterbox((w, h))
+                self.batch_letterboxes[frame.shape](frame, out=self.batch_data[i])
+            if self.decode == 'numpy':
+                outputs = self.sess.run(self.yolo_model.output,
+                    feed_dict={self.yolo_model.input: self.batch_data[:len(chunk)], K.learning_phase(): 0})
+                for i, frame in enumerate(chunk):
+                    results.append(self.decoder([o[i] for o in outputs], frame.shape[:2]))
+                continue
+            out_boxes, out_scores, out_classes, counts = self.sess.run(
+                self.batch_outputs,
+                feed_dict={
+                    self.yolo_model.input: self.batch_data[:len(chunk)],
+                    self.input_image_shapes: [frame.shape[:2] for frame in chunk],
+                    K.learning_phase(): 0
+                })
+            for i, n in enumerate(counts):
+                results.append((out_boxes[i, :n], out_scores[i, :n], out_classes[i, :n]))
+        return results
+
 def detect_video(yolo, video_path, output_path=""):
     video_path = 0 if video_path == '' else video_path
     vid = cv2.VideoCapture(video_path)